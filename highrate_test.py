@@ -0,0 +1,32 @@
+import nsautomate
+
+#A sampler over made up samples, no device is needed to build the report
+class FakeAgent:
+    def __init__(self):
+        self.systemFacts = {"hostname":"fake","product":"NetScreen-5400-III"}
+        self.remoteHost = "fake"
+
+sampler = nsautomate.HighRateSampler(FakeAgent(),["XMT*"],window=0.1)
+sampler.startMonotonic = 100.0
+sampler.startWall = 1000000.0
+#a single drop in a 1ms gap, 1000 packets per second over that gap
+sampler.series[(1,"XMT1-d")] = [(100.010,0),(100.500,0),(100.501,1),(101.000,1)]
+#40 drops spread over 4 intervals of 20ms inside the window from 100.3 to 100.4
+sampler.series[(1,"XMT2-d")] = [(100.310,0),(100.330,10),(100.350,20),(100.370,30),(100.390,40),(101.000,40)]
+#a counter that wraps, 16 drops in the window from 100.7 to 100.8
+sampler.series[(2,"XMT1-d")] = [(100.710,0xFFFFFFF8),(100.790,8)]
+
+for line in sampler.report(True):
+    print line
+
+windows = sampler.windows(1,"XMT2-d")
+assert len(windows) == 1 and windows[0][2] == 40
+assert sampler.windows(2,"XMT1-d")[0][2] == 16
+peak = sampler.report(False)[-1]
+assert peak.startswith("Peak packet loss of 40 packet(s) in ASIC 1 within queue XMT2-d"), peak
+assert "400 packets per second" in peak, peak
+
+#with no drops there is no peak
+sampler.series = {(1,"XMT1-d"):[(100.0,5),(100.1,5)]}
+assert sampler.report(False)[-1] == "No packet loss detected on host fake"
+print "OK"
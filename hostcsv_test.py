@@ -0,0 +1,69 @@
+import os
+import tempfile
+
+import nsautomate
+
+#Parse an inventory covering every kind of row HostParser handles, no devices are needed
+rows = [
+    "#host,username,password,port,timeout,queues",
+    "//C style comment",
+    "",
+    "10.0.0.1,admin,secret",
+    "10.0.0.2",
+    "  10.0.0.3 , admin , secret , 2222 , 30 , \"XMT*,RSM*\"",
+    "\"10.0.0.4\",\"user, with comma\",\"pass\"\"word\"",
+    "10.0.0.5,,,,,XMT1-d;CPU*",
+    "10.0.0.1,admin,secret,22",
+    "10.0.0.1,admin,secret,2222",
+    "10.0.0.1,admin,secret,2222",
+    "10.0.0.6,admin,secret,99999",
+    "10.0.0.7,admin,secret,port",
+    ",admin,secret",
+    "10.0.0.8,admin,secret,22,abc",
+    "10.0.0.9,admin,secret,22,-5",
+    "10.0.0.10,admin,secret,22,30,XMT*,extra",
+    "10.0.0.11,admin,secret,22,30",
+]
+handle,path = tempfile.mkstemp(suffix=".csv")
+inventory = os.fdopen(handle,"w")
+inventory.write("\n".join(rows) + "\n")
+inventory.close()
+
+try:
+    hp = nsautomate.HostParser(path,"netscreen","default",22)
+    hosts = hp.getHosts()
+    for item in hosts:
+        print item
+    for error in hp.errors:
+        print error
+
+    byHost = dict([((item["host"],item["options"].get("port")),item) for item in hosts])
+    assert [item["host"] for item in hosts] == ["10.0.0.1","10.0.0.2","10.0.0.3","10.0.0.4","10.0.0.5","10.0.0.1","10.0.0.11"]
+    assert byHost[("10.0.0.1",None)]["username"] == "admin" and byHost[("10.0.0.1",None)]["options"] == {}
+    assert byHost[("10.0.0.2",None)]["username"] == "netscreen" and byHost[("10.0.0.2",None)]["password"] == "default"
+    assert byHost[("10.0.0.3",2222)]["options"] == {"port":2222,"connectTimeout":30.0,"queuePatterns":["XMT*","RSM*"]}
+    assert byHost[("10.0.0.4",None)]["username"] == "user, with comma" and byHost[("10.0.0.4",None)]["password"] == "pass\"word"
+    assert byHost[("10.0.0.5",None)]["options"] == {"queuePatterns":["XMT1-d","CPU*"]}
+    #port 22 is the default port, so that row repeats 10.0.0.1, as does the second row on port 2222
+    assert hp.duplicates == 2
+    assert len(hp.errors) == 6
+    for line,reason in [(12,"invalid port 99999"),(13,"invalid port port"),(14,"no host given"),(15,"invalid timeout abc"),(16,"invalid timeout -5"),(17,"expected at most 6 columns")]:
+        assert [error for error in hp.errors if error.startswith("Skipped line %s of %s: %s" % (line,path,reason))], (line,reason)
+
+    #hostList is read once and then kept
+    assert hp.hostList is hp.hostList
+    assert hp.hostList == hosts
+
+    #with 2222 as the default port the row on port 22 is the separate host and the rows on port 2222 repeat the first
+    other = nsautomate.HostParser(path,port=2222)
+    assert [(item["host"],item["options"].get("port")) for item in other.getHosts() if item["host"] == "10.0.0.1"] == [("10.0.0.1",None),("10.0.0.1",22)]
+    assert other.duplicates == 2
+finally:
+    os.remove(path)
+
+try:
+    nsautomate.HostParser(path)
+    assert False
+except Exception, e:
+    assert str(e).startswith("Unable to open file %s" % (path))
+print "OK"
@@ -1,19 +1,32 @@
 #!/usr/bin/env python
 """
 Microburst detection tool for ASIC-based NetScreen platforms
+
+Can be run as a command line tool or imported as a library. The library
+API is NetScreenAgent for a single device session, HostParser to read a
+CSV inventory, OutputLogger for output and sweep() to poll many hosts.
+paramiko is only imported when the first connection is made.
 """
 import socket
-import paramiko
 import time
 import sys
 import re
 import select
-import exceptions
-import sys
 import datetime
-#non-module imports
-import argparse
-import getpass
+import array
+import struct
+import mmap
+import os
+import urllib
+import json
+import threading
+import Queue
+import fnmatch
+import zlib
+import csv
+import heapq
+import random
+import math
 
 #used to enable SSH debugging
 #paramiko.common.logging.basicConfig(level=paramiko.common.DEBUG)
@@ -24,72 +37,206 @@ import getpass
 ASICList = { "NetScreen-5400-II": { "productString":"NetScreen-5400-II","asic_list": [1,2,3,4,5,6], "qmu_list":[1,2,4,6,7,9]}, "NetScreen-5400-III": { "productString":"NetScreen-5400-III","asic_list": [1,2,3,4,5,6,9], "qmu_list":[1,2,4,6,7,9]}, "NetScreen-5200": { "productString":"NetScreen-5200","asic_list": [1,2,3,4,5,6,9], "qmu_list":[1,2,4,6,7,9]}, "NetScreen-5200-II": { "productString":"NetScreen-5200-II","asic_list": [1,2,3,4,5,6,9], "qmu_list":[1,2,4,6,7,9]}, "NetScreen-1000": { "productString":"NetScreen-1000", "asic_list": [0], "qmu_list":[1,2,4,6,7,9] }, "NetScreen-2000": { "productString":"NetScreen-2000", "asic_list": [0], "qmu_list":[1,2,4,6,7,9] }}
 #The buffer list data structure specifies which queues to look at for each qmu
 BUFFERList = {"1":["CPU2-d"], "2":["CPU1-d","RSM1-d"],"4":["L2Q-d"],"6":["SLU-d","SLI-d"],"7":["XMT1-d","XMT2-d","XMT3-d","XMT4-d","XMT5-d","XMT6-d","XMT7-d","XMT8-d"],"9":["RSM2-d","CPU3-d","CPU4-d","CPU5-d"]}
+#The command that reads the pktcnt counters of a qmu on each platform
+CounterCommands = {"NetScreen-5400-II":"get asic %(asic)s engine qmu pktcnt %(qmu)s", "NetScreen-5400-III":"get asic %(asic)s engine qmu pktcnt %(qmu)s", "NetScreen-5200":"get asic %(asic)s engine qmu pktcnt %(qmu)s", "NetScreen-5200-II":"get asic %(asic)s engine qmu pktcnt %(qmu)s", "NetScreen-1000":"get asic engine qmu pktcnt %(qmu)s", "NetScreen-2000":"get asic engine qmu pktcnt %(qmu)s"}
+
+def _monotonicClock():
+    """Return a clock function that never goes backwards, using clock_gettime on Linux when time.monotonic is not available"""
+    if hasattr(time,"monotonic"):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec",ctypes.c_long),("tv_nsec",ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"),use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int,ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            value = timespec()
+            if clock_gettime(CLOCK_MONOTONIC,ctypes.byref(value)) != 0:
+                raise OSError(ctypes.get_errno(),"clock_gettime failed")
+            return value.tv_sec + value.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (OSError,AttributeError,TypeError):
+        return time.time
+
+monotonic = _monotonicClock()
+
+def counterDelta(first,second):
+    """Return the packets counted between two reads of a hardware counter, the counters are 32 bits wide and wrap back to 0"""
+    return (second - first) & 0xFFFFFFFF
 
 class OutputLogger:
     """
     OutputLogger
 
     Handles writing to a file and priting output
+
+    logFormat is either text, the default, or jsonl to write one JSON object
+    per line. Structured records passed to logRecord are only written in
+    jsonl format. When background is set lines are handed to a writer
+    thread through a queue holding at most queueSize entries and written in
+    batches, so logging does not hold up collection. Call stop() to write
+    any queued lines before exiting, start() opens the file again and starts
+    a new writer thread.
     """
-    def __init__(self,output,outputFile=""):
+    def __init__(self,output,outputFile="",logFormat="text",background=False,queueSize=10000,batchSize=500):
         self.printStdout = output
         self.outputFileName = outputFile
+        self.logFormat = logFormat
         self.prefix = []
         self.suffix = []
+        self.prefixText = ""
+        self.suffixText = ""
+        self.lock = threading.Lock()
+        self.background = background
+        self.queueSize = queueSize
+        self.batchSize = batchSize
+        self.outputFile = None
+        self.queue = None
+        self.writer = None
         if self.outputFileName != "":
             self._openFile()
+        self._startWriter()
 
     def _openFile(self):
         self.outputFile = open(self.outputFileName, 'w')
 
+    def _startWriter(self):
+        """Start the writer thread when writing in the background and it is not already running"""
+        if self.background and self.writer is None:
+            self.queue = Queue.Queue(self.queueSize)
+            self.writer = threading.Thread(target=self._writerLoop)
+            self.writer.daemon = True
+            self.writer.start()
+
     def addPrefix(self,newPrefix):
         """Appends a prefix to the output. Each prefix added is put into a list. When a prefix is output each element is seperated by a space. The prefix is added to the front of the output after the timestamp"""
         self.prefix.append(newPrefix)
+        self.prefixText = " ".join(self.prefix)
 
     def clearPrefix(self):
         """Removes prefixes from logger"""
         self.prefix = []
+        self.prefixText = ""
 
     def clearSuffix(self):
         """Removes suffix from logger"""
         self.suffix = []
+        self.suffixText = ""
 
     def addSuffix(self,newSuffix):
         """Appends a suffix to the output. Each suffix added is put into a list. When a suffix is output each element is seperated by a space. The suffix is added to the end of the output."""
-        self.suffix.append(newPrefix)
+        self.suffix.append(newSuffix)
+        self.suffixText = " ".join(self.suffix)
 
     def _closeFile(self):
-        self.outputFile.close()
+        if self.outputFile is not None:
+            self.outputFile.close()
+            self.outputFile = None
 
     def start(self,outputFile=""):
+        """Open outputFile, if given, and start the writer thread again after stop()"""
+        if outputFile != "":
+            self._closeFile()
         self.outputFileName = outputFile
         if self.outputFileName != "":
             self._openFile()
+        self._startWriter()
 
     def stop(self):
+        """Write any queued lines, stop the writer thread and close the file"""
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+            self.queue = None
         self._closeFile()
 
-    def log(self,message,timestamp=False):
-        baseMessage = message
-
-        message = message.rstrip()
-
-        if len(self.prefix) > 0:
-            finalPrefix = " ".join(self.prefix)
-            message = "%s %s" % (finalPrefix,message)
-
-        if len(self.suffix) > 0:
-            finalSuffix = finalPrefix = " ".join(self.suffix)
-            message = "%s %s" % (message,finalSuffix)
-
-        if timestamp:
-            message = datetime.datetime.now().isoformat() + " " + message
-
-        if baseMessage != "" and baseMessage != "\n" and len(baseMessage) > 0:
-            if self.printStdout:
-                print message
-            if self.outputFileName != "":
-                self.outputFile.write(message + "\n")
+    def log(self,message,timestamp=False,when=None):
+        """Write a message to the configured outputs. When timestamp is set the message is prefixed with the time it was logged, or with when if a datetime or time.time() value is given"""
+        if message == "" or message == "\n":
+            return
+        if not timestamp:
+            when = None
+        elif when is None:
+            when = time.time()
+        self._emit((False,message.rstrip(),when,self.prefixText,self.suffixText))
+
+    def logRecord(self,record,when=None):
+        """Write a structured record such as a counter delta, only written when the log format is jsonl"""
+        if self.logFormat != "jsonl":
+            return
+        if when is None:
+            when = time.time()
+        self._emit((True,record,when,self.prefixText,self.suffixText))
+
+    def _emit(self,entry):
+        if self.queue is not None:
+            self.queue.put(entry)
+        else:
+            with self.lock:
+                self._write([entry])
+
+    def _format(self,entry):
+        """Turn a queued entry into a line of output"""
+        isRecord,message,when,prefixText,suffixText = entry
+        timestampText = None
+        if when is not None:
+            if not isinstance(when,datetime.datetime):
+                when = datetime.datetime.fromtimestamp(when)
+            timestampText = when.isoformat()
+        if self.logFormat == "jsonl":
+            if isRecord:
+                record = dict(message)
+            else:
+                record = {"message":message}
+            record["time"] = timestampText
+            if prefixText != "":
+                record["source"] = prefixText
+            return json.dumps(record,sort_keys=True)
+        if prefixText != "":
+            message = "%s %s" % (prefixText,message)
+        if suffixText != "":
+            message = "%s %s" % (message,suffixText)
+        if timestampText is not None:
+            message = timestampText + " " + message
+        return message
+
+    def _write(self,entries):
+        """Write a batch of entries to the outputs in a single call each"""
+        text = "".join([self._format(entry) + "\n" for entry in entries])
+        if self.printStdout:
+            sys.stdout.write(text)
+        if self.outputFile is not None:
+            self.outputFile.write(text)
+
+    def _writerLoop(self):
+        """Write queued entries in batches until stop() is called"""
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batchSize and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            finished = batch[-1] is None
+            if finished:
+                batch.pop()
+            if len(batch) > 0:
+                self._write(batch)
+                if self.printStdout:
+                    sys.stdout.flush()
+                if self.outputFile is not None:
+                    self.outputFile.flush()
+            if finished:
+                return
 
 class HostParser:
     """
@@ -98,6 +245,22 @@ class HostParser:
     This class is designed to parse a CSV file containing the host,
      username and password for devices that the user wishes to connect to.
 
+    The file is read one row at a time by hosts(), so large inventories can
+    be polled as they are read. Fields follow the usual CSV quoting rules.
+    An empty username or password uses the default given to the parser and
+    a host that appears more than once is only returned the first time.
+
+    Optional columns after the password:
+    port - the SSH port of the host
+    timeout - the number of seconds to wait when connecting to the host
+    queues - queue name patterns to read, separated by semicolons or spaces,
+     or by commas in a quoted field
+
+    Rows that can not be used are skipped and described in errors, the
+    number of duplicate hosts skipped is kept in duplicates. A host is a
+    duplicate when the same name and port appear again, rows without a port
+    use the default port given to the parser.
+
     Input CSV Example:
     #Comment lines start with #
     //Comments can also start with C flavored comments as well
@@ -105,137 +268,852 @@ class HostParser:
     1.2.3.4,foo,bar
     #hostname,username,password
     nshost.example.com,netscreen,netscreen
+    #hostname only, using the default username and password
+    nshost2.example.com
+    #host,username,password,port,timeout,queues
+    1.2.3.5,netscreen,netscreen,2222,30,"XMT*,RSM*"
 
     """
-    def __init__(self, sourceFile):
+    columns = ["host","username","password","port","timeout","queues"]
+
+    def __init__(self, sourceFile, username="", password="", port=22):
         """When creating the class you must specify the source file location"""
         self.sourceFile = sourceFile
-        self.hostList = [] # host,username,password
+        self.username = username
+        self.password = password
+        self.port = port
+        self._hostList = None
+        self.errors = []
+        self.duplicates = 0
         self.currentHost = 0
-        self._parse()
-    def _parse(self):
-        '''parse host file'''
+        self._open().close()
+
+    def _open(self):
+        try:
+            return open(self.sourceFile,"rb")
+        except IOError, e:
+            raise Exception("Unable to open file %s: %s" % (self.sourceFile,e.strerror))
+
+    def _hostItem(self,row):
+        """Build the host dict for a row, raises ValueError describing the problem with an invalid row"""
+        if len(row) > len(self.columns):
+            raise ValueError("expected at most %s columns (%s) but found %s" % (len(self.columns),",".join(self.columns),len(row)))
+        host,username,password,port,timeout,queues = row + [""] * (len(self.columns) - len(row))
+        if host == "":
+            raise ValueError("no host given")
+        item = {"host":host,"username":username or self.username,"password":password or self.password,"options":{}}
+        if port != "":
+            if not port.isdigit() or not 0 < int(port) < 65536:
+                raise ValueError("invalid port %s for host %s" % (port,host))
+            item["options"]["port"] = int(port)
+        if timeout != "":
+            try:
+                seconds = float(timeout)
+            except ValueError:
+                seconds = 0
+            if seconds <= 0:
+                raise ValueError("invalid timeout %s for host %s" % (timeout,host))
+            item["options"]["connectTimeout"] = seconds
+        if queues != "":
+            item["options"]["queuePatterns"] = [pattern for pattern in re.split("[,; ]+",queues) if pattern != ""]
+        return item
+
+    def hosts(self):
+        '''generate a dict with the host, username, password and agent options of every host in the file'''
+        self.errors = []
+        self.duplicates = 0
+        seen = set()
+        openFile = self._open()
+        reader = csv.reader(openFile,skipinitialspace=True)
         try:
-            openFile = open(self.sourceFile)
-            lines = openFile.readlines()
+            for row in reader:
+                row = [field.strip() for field in row]
+                if len(row) == 0 or row[0].startswith("#") or row[0].startswith("//") or "".join(row) == "":
+                    continue
+                try:
+                    item = self._hostItem(row)
+                except ValueError, e:
+                    self.errors.append("Skipped line %s of %s: %s" % (reader.line_num,self.sourceFile,e))
+                    continue
+                key = (item["host"].lower(),item["options"].get("port",self.port))
+                if key in seen:
+                    self.duplicates = self.duplicates + 1
+                    continue
+                seen.add(key)
+                yield item
+        except csv.Error, e:
+            raise Exception("Unable to read line %s of %s: %s" % (reader.line_num,self.sourceFile,e))
+        finally:
             openFile.close()
-            commentLineRE = re.compile("^#.*|^//.*")
-            newlineOnlyRE = re.compile("^\n$")
-            for line in lines:
-                if commentLineRE.match(line):
-                    '''Comment ignoring line'''
-                else:
-                    lineItems = line.split(",")
-                    if len(lineItems) == 3 and lineItems[0] != "" and lineItems[1] != "" and lineItems[2] != "":
-                        if newlineOnlyRE.match(lineItems[0]) or newlineOnlyRE.match(lineItems[1]) or newlineOnlyRE.match(lineItems[2]):
-                            """carrige return only found"""
-                        else:
-                            self.hostList.append({"host":lineItems[0].rstrip(),"username":lineItems[1].rstrip(),"password":lineItems[2].rstrip()})
-                    elif len(lineItems) == 1 and lineItems[0] == "" and lineItems[1] == "" and lineItems[2] == "":
-                        """Only host was specified"""
-                        if newlineOnlyRE.match(lineItems[0]) or newlineOnlyRE.match(lineItems[1]) or newlineOnlyRE.match(lineItems[2]):
-                            """carrige return only found"""
-                        else:
-                            self.hostList.append({"host":lineItems[0].rstrip(),"username":"","password":""})
-                    else:
-                        '''Ignore line'''
-        except:
-            raise Exception("Unable to open file")
+
     def getHosts(self):
-        '''return the current hostList as a list of dicts'''
-        return self.hostList
+        '''return every host in the file as a list of dicts, the file is read again on every call'''
+        return list(self.hosts())
+
+    def _getHostList(self):
+        if self._hostList is None:
+            self._hostList = self.getHosts()
+        return self._hostList
+
+    #every host in the file as a list, read once on first use
+    hostList = property(_getHostList)
+
+class AsicCounterTable:
+    """
+    AsicCounterTable
+
+    Holds the pktcnt counter samples for a single device. Values are stored
+    as integers in a flat array indexed by (asic, queue, sample) with a
+    matching byte array recording which entries have been read, and the
+    time each sample was taken is kept in times.
+    """
+    #pktcnt[XMT1-d  ] = 0x00000000          0
+    pktcntRE = re.compile("pktcnt\[\s*([^\]\s]+)\s*\]\s*=\s*0x([0-9a-fA-F]+)")
+
+    def __init__(self,asicList,queueList,samples=2):
+        self.asics = list(asicList)
+        self.queues = list(queueList)
+        self.samples = samples
+        self.asicIndex = dict([(asic,index) for index,asic in enumerate(self.asics)])
+        self.queueIndex = dict([(queue,index) for index,queue in enumerate(self.queues)])
+        size = len(self.asics) * len(self.queues) * samples
+        self.values = array.array("L",[0]) * size
+        self.present = bytearray(size)
+        self.times = array.array("d",[0.0]) * samples
+
+    def clearSample(self,sample):
+        """Mark every counter of a sample as not read"""
+        self.present[sample::self.samples] = bytearray(len(self.asics) * len(self.queues))
+
+    def parseCells(self,cells,sample,output):
+        """Parse the output of a pktcnt command using a map of queue name to cell index from a PollPlan, returns the number of counters stored"""
+        found = 0
+        for match in self.pktcntRE.finditer(output):
+            cell = cells.get(match.group(1))
+            if cell is not None:
+                offset = cell * self.samples + sample
+                self.values[offset] = int(match.group(2),16)
+                self.present[offset] = 1
+                found = found + 1
+        return found
+
+    def get(self,asic,queue,sample):
+        """Return a counter value, or None if it has not been read or the table has no such asic or queue"""
+        asicIndex = self.asicIndex.get(asic)
+        queueIndex = self.queueIndex.get(queue)
+        if asicIndex is None or queueIndex is None:
+            return None
+        offset = (asicIndex * len(self.queues) + queueIndex) * self.samples + sample
+        if self.present[offset]:
+            return self.values[offset]
+        return None
+
+class PollPlan:
+    """
+    PollPlan
+
+    The commands needed to read the selected queues of a product, built
+    once from ASICList, BUFFERList and CounterCommands. commands holds one
+    command per (asic, qmu) that has a selected queue, in the order they
+    are sent, and commandAsics the asic each command reads. parseMap holds
+    a dict for each command mapping the queue names it returns to a cell of
+    an AsicCounterTable created by newTable(), and cells maps each cell
+    back to its (asic, queue).
+
+    Use pollPlan() to get a plan, plans are cached and shared by every
+    session to the same product.
+    """
+    def __init__(self,product,queuePatterns=None,qmus=None,asics=None):
+        self.product = product
+        self.queuePatterns = queuePatterns or ["*"]
+        template = CounterCommands[product]
+        asicList = [asic for asic in ASICList[product]["asic_list"] if asics is None or asic in asics]
+        qmuList = [qmu for qmu in ASICList[product]["qmu_list"] if qmus is None or qmu in qmus]
+        selected = {}
+        self.queues = []
+        for qmu in qmuList:
+            selected[qmu] = [queue for queue in BUFFERList[str(qmu)] if [pattern for pattern in self.queuePatterns if fnmatch.fnmatchcase(queue,pattern)]]
+            self.queues.extend(selected[qmu])
+        self.asics = asicList
+        queueIndex = dict([(queue,index) for index,queue in enumerate(self.queues)])
+        self.commands = []
+        self.commandAsics = []
+        self.parseMap = []
+        self.cells = []
+        for asic in asicList:
+            for queue in self.queues:
+                self.cells.append((asic,queue))
+        for asicOffset,asic in enumerate(asicList):
+            for qmu in qmuList:
+                if len(selected[qmu]) == 0:
+                    continue
+                self.commands.append(template % {"asic":asic,"qmu":qmu})
+                self.commandAsics.append(asic)
+                self.parseMap.append(dict([(queue,asicOffset * len(self.queues) + queueIndex[queue]) for queue in selected[qmu]]))
+
+    def newTable(self,samples=2):
+        """Create an empty AsicCounterTable laid out for this plan"""
+        return AsicCounterTable(self.asics,self.queues,samples)
+
+_pollPlans = {}
+_pollPlansLock = threading.Lock()
+
+def pollPlan(product,queuePatterns=None,qmus=None,asics=None):
+    """Return the PollPlan for a product and queue selection, or None if the product has no ASIC counters"""
+    if product not in CounterCommands:
+        return None
+    key = (product,tuple(queuePatterns or ["*"]),None if qmus is None else tuple(qmus),None if asics is None else tuple(asics))
+    with _pollPlansLock:
+        plan = _pollPlans.get(key)
+        if plan is None:
+            plan = PollPlan(product,queuePatterns,qmus,asics)
+            _pollPlans[key] = plan
+        return plan
+
+class CounterStore:
+    """
+    CounterStore
+
+    Append-only on disk history of counter samples. Every (host, asic, queue)
+    series is kept in its own file of fixed width records, each holding the
+    sample time as a double and the counter value as an unsigned 64 bit
+    integer. Series are read through mmap and searched by time, so queries
+    only touch the records they return.
+
+    Directory layout:
+    path/<host>/<asic>_<queue>.cnt
+    """
+    record = struct.Struct("<dQ")
+    suffix = ".cnt"
+
+    def __init__(self,path):
+        self.path = path
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _seriesPath(self,host,asic,queue):
+        return os.path.join(self.path,urllib.quote(str(host),safe=""),"%s_%s%s" % (asic,urllib.quote(queue,safe=""),self.suffix))
+
+    def append(self,host,asic,queue,timestamp,value):
+        """Add a single sample to the end of a series"""
+        self.appendMany(host,[(asic,queue,timestamp,value)])
+
+    def appendTable(self,host,table,sample):
+        """Add every counter read in one sample of an AsicCounterTable"""
+        samples = []
+        for asic in table.asics:
+            for queue in table.queues:
+                value = table.get(asic,queue,sample)
+                if value is not None:
+                    samples.append((asic,queue,table.times[sample],value))
+        self.appendMany(host,samples)
+
+    def appendMany(self,host,samples):
+        """Add a list of (asic, queue, timestamp, value) samples for a host"""
+        with self.lock:
+            hostPath = os.path.join(self.path,urllib.quote(str(host),safe=""))
+            if not os.path.isdir(hostPath):
+                os.makedirs(hostPath)
+            for asic,queue,timestamp,value in samples:
+                seriesFile = open(self._seriesPath(host,asic,queue),"ab")
+                seriesFile.write(self.record.pack(timestamp,value))
+                seriesFile.close()
+
+    def series(self):
+        """Return a list of (host, asic, queue) for every series in the store"""
+        result = []
+        for hostDir in sorted(os.listdir(self.path)):
+            hostPath = os.path.join(self.path,hostDir)
+            if not os.path.isdir(hostPath):
+                continue
+            for name in sorted(os.listdir(hostPath)):
+                if name.endswith(self.suffix):
+                    asic,queue = name[:-len(self.suffix)].split("_",1)
+                    result.append((urllib.unquote(hostDir),int(asic),urllib.unquote(queue)))
+        return result
+
+    def _search(self,data,count,timestamp):
+        """Return the index of the first record at or after timestamp"""
+        low = 0
+        high = count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record.unpack_from(data,middle * self.record.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def range(self,host,asic,queue,start=None,end=None):
+        """Return the (timestamp, value) samples of a series taken at or after start and before end"""
+        try:
+            seriesFile = open(self._seriesPath(host,asic,queue),"rb")
+        except IOError:
+            return []
+        try:
+            #ignore a partly written record at the end of the file
+            count = os.fstat(seriesFile.fileno()).st_size // self.record.size
+            if count == 0:
+                return []
+            data = mmap.mmap(seriesFile.fileno(),0,access=mmap.ACCESS_READ)
+            try:
+                first = 0
+                last = count
+                if start is not None:
+                    first = self._search(data,count,start)
+                if end is not None:
+                    last = self._search(data,count,end)
+                return [self.record.unpack_from(data,index * self.record.size) for index in xrange(first,last)]
+            finally:
+                data.close()
+        finally:
+            seriesFile.close()
+
+    def dropRates(self,host,asic,queue,start=None,end=None):
+        """Return (start, end, drops, drops per second) for each interval between samples of a series"""
+        result = []
+        samples = self.range(host,asic,queue,start,end)
+        for index in range(1,len(samples)):
+            previousTime,previousValue = samples[index - 1]
+            sampleTime,value = samples[index]
+            drops = counterDelta(previousValue,value)
+            elapsed = sampleTime - previousTime
+            if elapsed > 0:
+                rate = drops / elapsed
+            else:
+                rate = 0.0
+            result.append((previousTime,sampleTime,drops,rate))
+        return result
+
+class FactsCache:
+    """
+    FactsCache
+
+    Keeps the system facts of each host in a JSON file so they do not have
+    to be gathered again on every connection. Entries expire after ttl
+    seconds. When facts are stored for a host whose cached software version
+    differs, the entry is replaced and the change is counted in
+    versionChanges. Changes are written to disk by save().
+    """
+    def __init__(self,path,ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.versionChanges = 0
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                cacheFile = open(self.path)
+                self.entries = json.load(cacheFile)
+                cacheFile.close()
+            except ValueError:
+                #start again from an empty cache if the file is damaged
+                self.entries = {}
+
+    def get(self,host):
+        """Return a copy of the cached facts for a host, or None if there is no current entry"""
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is None or time.time() - entry["time"] > self.ttl:
+                return None
+            return dict(entry["facts"])
+
+    def put(self,host,facts):
+        """Store the facts gathered from a host"""
+        with self.lock:
+            previous = self.entries.get(host)
+            if previous is not None and previous["facts"].get("version") != facts.get("version"):
+                self.versionChanges = self.versionChanges + 1
+            self.entries[host] = {"time":time.time(),"facts":dict(facts)}
+            self.dirty = True
+
+    def invalidate(self,host):
+        """Remove the entry for a host so its facts are gathered on the next connection"""
+        with self.lock:
+            if host in self.entries:
+                del self.entries[host]
+                self.dirty = True
+
+    def export(self,hosts):
+        """Return the entries of a list of hosts, with None for hosts that have no entry"""
+        with self.lock:
+            return dict([(host,self.entries.get(host)) for host in hosts])
+
+    def merge(self,entries):
+        """Apply entries returned by export() from another copy of the cache, None removes the entry of a host"""
+        with self.lock:
+            for host,entry in entries.items():
+                if entry is None:
+                    if host in self.entries:
+                        del self.entries[host]
+                        self.dirty = True
+                elif self.entries.get(host) != entry:
+                    self.entries[host] = entry
+                    self.dirty = True
+
+    def save(self):
+        """Write the cache to disk if it has changed, replacing the old file in a single step"""
+        with self.lock:
+            if not self.dirty:
+                return
+            tempPath = self.path + ".tmp"
+            cacheFile = open(tempPath,"w")
+            json.dump(self.entries,cacheFile)
+            cacheFile.close()
+            os.rename(tempPath,self.path)
+            self.dirty = False
+
+class SessionTimeout(Exception):
+    """Raised when a device session passes its command or session deadline"""
+    pass
+
+class PromptReader:
+    """
+    PromptReader
+
+    Reads the output of a shell channel and splits it on the device prompt.
+    Data is received in large chunks into a single bytearray and only the
+    bytes that arrived since the last search are scanned for the prompt, so
+    the cost of reading a command's output grows linearly with its size.
+    Anything received after a prompt is kept for the next read.
+
+    promptTime holds the monotonic time the chunk containing the last prompt
+    was received and bytesRead the number of bytes received in total.
+
+    The channel is only read once select() reports data waiting. A read
+    raises SessionTimeout if the prompt has not arrived within
+    commandTimeout seconds or by sessionDeadline, a monotonic time, so a
+    device that stops part way through its output or shows an unexpected
+    prompt can not block forever. With neither set reads wait forever.
+    """
+    def __init__(self,chan,host,promptEnding="->",chunkSize=32768,commandTimeout=None,sessionDeadline=None):
+        self.chan = chan
+        self.host = host
+        self.promptEnding = promptEnding
+        self.chunkSize = chunkSize
+        self.commandTimeout = commandTimeout
+        self.sessionDeadline = sessionDeadline
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.received = 0
+        self.promptTime = 0
+        self.bytesRead = 0
+
+    def _fill(self,deadline):
+        """Receive the next chunk of data from the channel, waiting until the deadline at most"""
+        if deadline is not None and not self.chan.recv_ready():
+            remaining = deadline - monotonic()
+            if remaining <= 0 or len(select.select([self.chan],[],[],remaining)[0]) == 0:
+                raise SessionTimeout("Timed out waiting for output from host: %s" % (self.host))
+        try:
+            data = self.chan.recv(self.chunkSize)
+        except socket.timeout:
+            raise SessionTimeout("Timed out waiting for output from host: %s" % (self.host))
+        if len(data) == 0:
+            raise Exception("Connection closed by host: %s" % (self.host))
+        self.received = monotonic()
+        self.bytesRead = self.bytesRead + len(data)
+        self.buffer.extend(data)
+
+    def readUntilPrompt(self):
+        """Read until the next prompt and return everything received before the line containing it"""
+        deadline = self.sessionDeadline
+        if self.commandTimeout is not None:
+            commandDeadline = monotonic() + self.commandTimeout
+            if deadline is None or commandDeadline < deadline:
+                deadline = commandDeadline
+        while True:
+            index = self.buffer.find(self.promptEnding,self.scanned)
+            if index != -1:
+                break
+            #the prompt may be split across two chunks
+            self.scanned = max(0,len(self.buffer) - len(self.promptEnding) + 1)
+            self._fill(deadline)
+        self.promptTime = self.received
+        lineStart = self.buffer.rfind("\n",0,index) + 1
+        end = index + len(self.promptEnding)
+        if self.buffer[end:end + 1] == " ":
+            end = end + 1
+        output = str(self.buffer[:lineStart])
+        del self.buffer[:end]
+        self.scanned = 0
+        return output
+
+def latencyPercentiles(samples):
+    """Return the nearest rank 50th, 90th and 99th percentile and the maximum of a list of times in seconds"""
+    samples = sorted(samples)
+    result = {"count":len(samples)}
+    if len(samples) > 0:
+        for percentile in [50,90,99]:
+            result["p%s" % (percentile)] = samples[int(math.ceil(len(samples) * percentile / 100.0)) - 1]
+        result["max"] = samples[-1]
+    return result
+
+class SessionTiming:
+    """
+    SessionTiming
+
+    Records where the time of a single device session goes. phases holds
+    the total seconds spent in each phase of the session, commands holds
+    the count, total seconds, bytes received and slowest time of every
+    distinct command and latencies the time of each command run.
+    """
+    phaseNames = ["tcp_connect","ssh_handshake","auth","invoke_shell","disable_paging","system_facts","parse","disconnect"]
+
+    def __init__(self,host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.commands = {}
+        self.latencies = array.array("d")
+
+    def __getstate__(self):
+        #the lock can not be pickled, sessions are sent back from worker processes by ShardedSweep
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def phase(self,name,start):
+        """Add the time since start to a phase, returns the current monotonic time so phases can be chained"""
+        now = monotonic()
+        with self.lock:
+            self.phases[name] = self.phases.get(name,0) + now - start
+        return now
+
+    def command(self,command,seconds,received):
+        """Record a single command that took seconds and received a number of bytes"""
+        with self.lock:
+            self.latencies.append(seconds)
+            stats = self.commands.get(command)
+            if stats is None:
+                self.commands[command] = [1,seconds,received,seconds]
+            else:
+                stats[0] = stats[0] + 1
+                stats[1] = stats[1] + seconds
+                stats[2] = stats[2] + received
+                stats[3] = max(stats[3],seconds)
+
+    def summary(self):
+        """Return the timing of the session as a dict"""
+        commands = {}
+        for command,(count,seconds,received,slowest) in self.commands.items():
+            commands[command] = {"count":count,"seconds":seconds,"bytes":received,"max":slowest}
+        return {"host":self.host,
+            "phases":dict(self.phases),
+            "commands":commands,
+            "commandSeconds":sum(self.latencies),
+            "commandBytes":sum([stats["bytes"] for stats in commands.values()]),
+            "commandLatency":latencyPercentiles(self.latencies)}
+
+class TimingReport:
+    """
+    TimingReport
+
+    Collects the SessionTiming of every device session of a run and
+    summarises them per host and across the fleet. Pass it to
+    NetScreenAgent as timing to instrument a session, with no TimingReport
+    the agent does not time anything.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = []
+
+    def newSession(self,host):
+        """Create and return the SessionTiming for a new session to a host"""
+        session = SessionTiming(host)
+        with self.lock:
+            self.sessions.append(session)
+        return session
+
+    def addSessions(self,sessions):
+        """Add SessionTimings recorded by another TimingReport, for example in another process"""
+        with self.lock:
+            self.sessions.extend(sessions)
+
+    def summary(self):
+        """Return the per session timings and the fleet wide percentiles as a dict"""
+        with self.lock:
+            sessions = list(self.sessions)
+        fleet = {"sessions":len(sessions),"phases":{}}
+        for name in SessionTiming.phaseNames:
+            times = [session.phases[name] for session in sessions if name in session.phases]
+            if len(times) > 0:
+                fleet["phases"][name] = latencyPercentiles(times)
+        latencies = []
+        for session in sessions:
+            latencies.extend(session.latencies)
+        fleet["commandLatency"] = latencyPercentiles(latencies)
+        return {"sessions":[session.summary() for session in sessions],"fleet":fleet}
+
+    def _formatPercentiles(self,stats):
+        if stats["count"] == 0:
+            return "none"
+        return "p50 %.4fs p90 %.4fs p99 %.4fs max %.4fs" % (stats["p50"],stats["p90"],stats["p99"],stats["max"])
+
+    def summaryLines(self,summary=None):
+        """Return the summary as lines of text, one per session followed by the fleet percentiles"""
+        if summary is None:
+            summary = self.summary()
+        lines = []
+        for session in summary["sessions"]:
+            phases = " ".join(["%s %.4fs" % (name,session["phases"][name]) for name in SessionTiming.phaseNames if name in session["phases"]])
+            lines.append("Timing for host %s: %s, %s commands %.4fs %s bytes, command %s" % (session["host"],phases,session["commandLatency"]["count"],session["commandSeconds"],session["commandBytes"],self._formatPercentiles(session["commandLatency"])))
+        fleet = summary["fleet"]
+        lines.append("Fleet timing over %s sessions, command %s" % (fleet["sessions"],self._formatPercentiles(fleet["commandLatency"])))
+        for name in SessionTiming.phaseNames:
+            if name in fleet["phases"]:
+                lines.append("Fleet timing over %s sessions, %s %s" % (fleet["sessions"],name,self._formatPercentiles(fleet["phases"][name])))
+        return lines
+
+    def save(self,path,summary=None):
+        """Write the summary to a file as JSON"""
+        if summary is None:
+            summary = self.summary()
+        timingFile = open(path,"w")
+        json.dump(summary,timingFile,indent=2,sort_keys=True)
+        timingFile.write("\n")
+        timingFile.close()
 
 class NetScreenAgent:
-    def __init__(self,hostname,username,password,output):
-        """Initalize the object with the correct hostname,username, and password"""
+    def __init__(self,hostname,username,password,output,pipelineDepth=1,port=22,factsCache=None,timing=None,queuePatterns=None,primeReads=False,connectTimeout=15,commandTimeout=60,sessionTimeout=None,channels=1):
+        """Initalize the object with the correct hostname,username, and password
+
+        port is the SSH port of the device. pipelineDepth sets how many
+        commands are written to the shell at once by runCommands, a depth of
+        1 waits for the prompt after every command. factsCache is an optional
+        FactsCache used to skip gathering the system facts on connect.
+        timing is an optional TimingReport the phases and commands of the
+        session are recorded in. queuePatterns limits the queues read to
+        those matching any of the shell style patterns, primeReads reads
+        every counter twice per sample and only keeps the second read.
+        connectTimeout is the number of seconds to wait for the device when
+        connecting. commandTimeout is the number of seconds to wait for a
+        command to finish and sessionTimeout the number of seconds the whole
+        session may take from the start of connect(), after either the
+        session is closed and SessionTimeout is raised. None waits
+        forever. channels is the number of shell sessions opened on the SSH
+        connection to read the ASICs of a chassis at the same time."""
         self.systemFacts = {"hostname":"","product":"","serialNumber":"","controlNumber":"","version":"","type":""}
         self.remoteHost = hostname
+        self.port = port
+        self.connectTimeout = connectTimeout
+        self.commandTimeout = commandTimeout
+        self.sessionTimeout = sessionTimeout
+        self.sessionDeadline = None
         self.promptEnding = "->"
-        self.promptRegex = re.compile(".*->")
         self.username = username
         self.password = password
         self.platform = ""
-        self.asicCounters = dict()
+        self.asicCounters = None
+        self.pipelineDepth = max(1,int(pipelineDepth))
+        self.factsCache = factsCache
+        self.factsFromCache = False
+        self.queuePatterns = queuePatterns
+        self.primeReads = primeReads
+        self.channels = max(1,int(channels))
+        self.readers = []
+        self.timing = None
+        if timing is not None:
+            self.timing = timing.newSession(hostname)
         if output:
             self.output = output
         else:
             self.output = False
 
+    def _phaseTimeout(self,limit):
+        """Return the seconds a phase of the connection may take, limit cut short by the session deadline"""
+        if self.sessionDeadline is not None:
+            remaining = max(0.001,self.sessionDeadline - monotonic())
+            if limit is None or remaining < limit:
+                return remaining
+        return limit
+
     def connect(self):
-        """Create a connection to the remote device"""
+        """Create a connection to the remote device
+
+        The TCP connection, the SSH handshake and the authentication may
+        each take connectTimeout seconds, none of them past the session
+        deadline. A phase that runs out of time raises SessionTimeout
+        naming the phase."""
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(15)
+        phase = "connecting to"
+        limitTime = None
         try:
-            self.socket.connect((self.remoteHost,22))
+            #imported here so the library and the command line help load quickly
+            import paramiko
+            timing = self.timing
+            start = monotonic()
+            if self.sessionTimeout is not None:
+                self.sessionDeadline = start + self.sessionTimeout
+            limit = self._phaseTimeout(self.connectTimeout)
+            self.socket.settimeout(limit)
+            self.socket.connect((self.remoteHost,self.port))
+            if timing is not None:
+                start = timing.phase("tcp_connect",start)
+            phase = "in the SSH handshake with"
+            limit = self._phaseTimeout(self.connectTimeout)
+            limitTime = limit and monotonic() + limit
             self.transport = paramiko.Transport(self.socket)
+            #paramiko gives up on the handshake by itself, raising SSHException
+            self.transport.banner_timeout = limit
+            self.transport.handshake_timeout = limit
             self.transport.start_client()
+            if timing is not None:
+                start = timing.phase("ssh_handshake",start)
+            phase = "authenticating to"
+            limit = self._phaseTimeout(self.connectTimeout)
+            limitTime = limit and monotonic() + limit
+            self.transport.auth_timeout = limit
             self.transport.auth_password(username=self.username,password=self.password)
-            self.chan = self.transport.open_session()
-            self.chan.set_combine_stderr(False)
-            self.chan.setblocking(blocking=1)
-            self.chan.settimeout(None)
-            self.chan.invoke_shell()
-            while self.chan.send_ready() != True:
-                pass
-            self._disablePaging()
-        except:
+            if timing is not None:
+                timing.phase("auth",start)
+            phase = "opening a shell on"
+            limitTime = None
+            self.reader = self._openShell()
+            self.chan = self.reader.chan
+            self.readers = [self.reader]
+        except Exception, e:
+            self.abort()
+            if isinstance(e,(SessionTimeout,socket.timeout)) or (limitTime is not None and monotonic() >= limitTime):
+                raise SessionTimeout("Timed out %s host: %s" % (phase,self.remoteHost))
             raise Exception("Unable to connect to host: %s" % (self.remoteHost))
 
-    def _runSilentCommand(self,command,maxMatch):
+    def _openShell(self):
+        """Open a shell session on the connection with paging disabled, returns the PromptReader for it"""
+        timing = self.timing
+        start = monotonic()
+        chan = self.transport.open_session()
+        try:
+            chan.set_combine_stderr(False)
+            chan.setblocking(blocking=1)
+            chan.settimeout(self.commandTimeout)
+            chan.invoke_shell()
+            reader = PromptReader(chan,self.remoteHost,self.promptEnding,commandTimeout=self.commandTimeout,sessionDeadline=self.sessionDeadline)
+            while chan.send_ready() != True:
+                if self.commandTimeout is not None and monotonic() - start > self.commandTimeout:
+                    raise SessionTimeout("Timed out opening a shell on host: %s" % (self.remoteHost))
+                time.sleep(0.001)
+            if timing is not None:
+                start = timing.phase("invoke_shell",start)
+            self._disablePaging(reader)
+            if timing is not None:
+                timing.phase("disable_paging",start)
+        except:
+            chan.close()
+            raise
+        return reader
+
+    def _shellReaders(self,count):
+        """Return the PromptReaders of up to count shells, opening more shells on the connection as needed
+
+        When the device refuses another session, or closes or stops
+        answering a new one, no more shells are opened and the shells
+        already open are used."""
+        while len(self.readers) < min(count,self.channels):
+            try:
+                self.readers.append(self._openShell())
+            except Exception:
+                self.channels = len(self.readers)
+        return self.readers[:count]
+
+    def _runSilentCommand(self,command,maxMatch,reader=None):
         """Run a command and supress any output, used for simple housekeeping tasks"""
-        self.chan.send(command + "\n")
-        coutstr=""
-        result=""
-        promptMatch = 0
-        while True:
-            coutstr = self.chan.recv(1024)
-            result += coutstr
-            if len(coutstr) < 1024:
-                lines = result.splitlines()
-                for line in lines:
-                    #print "SILENT " + line
-                    if self.promptRegex.match(line):
-                        promptMatch = promptMatch + 1
-                        if promptMatch == maxMatch:
-                            return
-
-    def _disablePaging(self):
+        reader = reader or self.reader
+        reader.chan.send(command + "\n")
+        for promptMatch in range(maxMatch):
+            reader.readUntilPrompt()
+
+    def _disablePaging(self,reader=None):
         """disables paging on the console to prevent the need to interact with a pagnated set of output"""
-        self._runSilentCommand("set console page 0",2)
+        self._runSilentCommand("set console page 0",2,reader)
 
     def _enablePaging(self):
         """disables paging on the console to prevent the need to interact with a pagnated set of output"""
         self._runSilentCommand("set console page 20",1)
 
-    def runCommand(self,command):
-        """Run a specified command against the device, returns the output of the command"""
+    def runCommand(self,command,reader=None):
+        """Run a specified command against the device, returns the output of the command
+
+        reader is the PromptReader of the shell to run the command in,
+        by default the shell opened by connect()."""
         #validate connected before running command
-        self.chan.send(command + "\n")
-        coutstr=""
-        result=""
-        finalOutput = ""
-        promptMatch = 0
-        lineCount = 0
-        while True:
-            coutstr = self.chan.recv(1024)
-            result += coutstr
-            if len(coutstr) < 1024:
-                lines = result.splitlines()
-                for line in lines:
-                    lineCount = lineCount + 1
-                    if self.promptRegex.match(line):
-                        promptMatch = promptMatch + 1
-                        if promptMatch == 1:
-                            return finalOutput
-                    elif lineCount == 1:
-                        """Skip processing this line"""
-                    else:
-                        finalOutput = finalOutput + line + "\n"
+        reader = reader or self.reader
+        timing = self.timing
+        if timing is not None:
+            start = monotonic()
+            received = reader.bytesRead
+        reader.chan.send(command + "\n")
+        lines = reader.readUntilPrompt().splitlines()
+        if timing is not None:
+            timing.command(command,monotonic() - start,reader.bytesRead - received)
+        #the first line is the echo of the command
+        return "".join([line + "\n" for line in lines[1:]])
+
+    def runCommands(self,commands,reader=None):
+        """Run a list of commands against the device, returns a list with the output of each command
+
+        Commands are written to the shell in batches of pipelineDepth without
+        waiting for the prompt in between. The returned stream is split back
+        into the output of each command on the prompt, the line following
+        each prompt must be the echo of the next command in the batch."""
+        results = []
+        if self.pipelineDepth == 1:
+            for command in commands:
+                results.append(self.runCommand(command,reader))
+            return results
+        for start in range(0,len(commands),self.pipelineDepth):
+            results.extend(self._runCommandBatch(commands[start:start + self.pipelineDepth],reader or self.reader))
+        return results
+
+    def _runCommandBatch(self,commands,reader):
+        """Write a batch of commands in a single send and split the output on the prompts"""
+        timing = self.timing
+        if timing is not None:
+            start = monotonic()
+            received = reader.bytesRead
+        reader.chan.sendall("\n".join(commands) + "\n")
+        outputs = []
+        for command in commands:
+            lines = reader.readUntilPrompt().splitlines()
+            if timing is not None:
+                #each command is timed from the prompt of the one before it
+                now = monotonic()
+                timing.command(command,now - start,reader.bytesRead - received)
+                start = now
+                received = reader.bytesRead
+            #skip blank lines between the prompt and the command echo
+            while len(lines) > 0 and lines[0].strip() == "":
+                lines.pop(0)
+            if len(lines) == 0 or lines[0].strip() != command:
+                raise Exception("Unexpected command echo from host: %s" % (self.remoteHost))
+            outputs.append("".join([line + "\n" for line in lines[1:]]))
+        return outputs
 
     def getSystemFacts(self):
-        """Gets all of the needed system facts"""
-        self.getHostname()
-        self.checkPlatform()
+        """Gets all of the needed system facts, using the facts cache when it holds a current entry for this host"""
+        if self.factsCache is not None:
+            facts = self.factsCache.get(self.remoteHost)
+            if facts is not None:
+                self.systemFacts.update(facts)
+                self.factsFromCache = True
+                return
+        start = monotonic()
+        try:
+            self.getHostname()
+            self.checkPlatform()
+        except SessionTimeout:
+            raise SessionTimeout("Timed out gathering system facts from host: %s" % (self.remoteHost))
+        if self.timing is not None:
+            self.timing.phase("system_facts",start)
+        self.factsFromCache = False
+        if self.factsCache is not None and self.systemFacts["product"] != "":
+            self.factsCache.put(self.remoteHost,self.systemFacts)
 
     def getHostname(self):
         """Get system hostname"""
@@ -283,99 +1161,110 @@ class NetScreenAgent:
                 self.systemFacts["version"] = result.group(1)
                 self.systemFacts["type"] = result.group(2)
 
-    def _getAsicCounter(self,asicid,qmuid):
-        """Get the counters from the specified asic"""
-        if self.systemFacts["product"] == "":
-            #print "Product facts not gathered"
-            pass
-        #ISG Match
-        elif self.systemFacts["product"] == ASICList["NetScreen-2000"]["productString"] or self.systemFacts["product"] == ASICList["NetScreen-1000"]["productString"]:
-            output = self.runCommand("get asic engine qmu pktcnt %s" % (qmuid))
-            return output
-        #NS5400 Match
-        elif self.systemFacts["product"] == ASICList["NetScreen-5400-II"]["productString"] or self.systemFacts["product"] == ASICList["NetScreen-5400-III"]["productString"]:
-            output = self.runCommand("get asic %s engine qmu pktcnt %s" % (asicid,qmuid))
-            return output
-        #NS52000 Match
-        elif self.systemFacts["product"] == ASICList["NetScreen-5200-II"]["productString"] or self.systemFacts["product"] == ASICList["NetScreen-5200"]["productString"]:
-            output = self.runCommand("get asic %s engine qmu pktcnt %s" % (asicid,qmuid))
-            return output
-
-    def _compileAsicDict(self,endValues,asicid,queueList,runid,lines):
-        """parse asic data"""
-        for queue in queueList:
-            if queue in endValues[asicid]:
-                """queue initilized already"""
-            else:
-                endValues[asicid][queue] = {}
-
-            if runid in endValues[asicid][queue]:
-                """runid initalized already"""
+    def pollPlan(self):
+        """Return the PollPlan for the product and selected queues of this device, or None for an unknown product"""
+        return pollPlan(self.systemFacts["product"],self.queuePatterns)
+
+    def newCounterTable(self,samples=2):
+        """Create an empty AsicCounterTable for the selected ASICs and queues of this platform"""
+        return self.pollPlan().newTable(samples)
+
+    def _readCounters(self,commands,reader=None):
+        """Run the pktcnt commands in a shell, returns a list with the output of each command"""
+        if self.primeReads:
+            #read every counter twice and keep the second read
+            doubled = []
+            for command in commands:
+                doubled.append(command)
+                doubled.append(command)
+            return self.runCommands(doubled,reader)[1::2]
+        return self.runCommands(commands,reader)
+
+    def _readCountersParallel(self,plan,readers):
+        """Run the pktcnt commands of a plan split by ASIC across several shells at the same time, returns a list with the output of each command"""
+        groups = [[] for reader in readers]
+        for index,asic in enumerate(plan.commandAsics):
+            groups[plan.asics.index(asic) % len(readers)].append(index)
+        outputs = [None] * len(plan.commands)
+        errors = []
+        def read(group,reader):
+            try:
+                for index,output in zip(group,self._readCounters([plan.commands[index] for index in group],reader)):
+                    outputs[index] = output
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=read,args=(group,reader)) for group,reader in zip(groups[1:],readers[1:])]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        read(groups[0],readers[0])
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+        return outputs
+
+    def sampleAsicCounters(self,table,sample,verboseOutput=None):
+        """Take a single sample of the selected ASIC counters on the platform and store it in a table from newCounterTable() as the given sample
+
+        With more than one channel the ASICs are shared out between that
+        many shells and read at the same time."""
+        plan = self.pollPlan()
+        if plan is not None:
+            if len(plan.commands) == 0:
+                raise Exception("No queues match %s on host: %s" % (",".join(plan.queuePatterns),self.remoteHost))
+            readers = self.readers[:1]
+            if self.channels > 1 and len(plan.asics) > 1:
+                readers = self._shellReaders(len(plan.asics))
+            if len(readers) > 1:
+                outputs = self._readCountersParallel(plan,readers)
             else:
-                endValues[asicid][queue][runid] = ""
-
-            queueRE = re.compile("pktcnt\[%s\s+\]\s=\s(0x\d{8})\s+(\d*)" % (queue))
-            for line in lines:
-                if queueRE.match(line):
-                    matchResult = queueRE.match(line)
-                    endValues[asicid][queue][runid] = matchResult.group(1)
-
-            return endValues
+                outputs = self._readCounters(plan.commands)
+            start = monotonic()
+            table.clearSample(sample)
+            table.times[sample] = time.time()
+            found = 0
+            for cells,output in zip(plan.parseMap,outputs):
+                if verboseOutput is not None:
+                    verboseOutput.extend(output.split("\n"))
+                found = found + table.parseCells(cells,sample,output)
+            if self.timing is not None:
+                self.timing.phase("parse",start)
+            if found == 0 and self.factsFromCache:
+                #the device no longer matches the cached facts, for example after an upgrade
+                self.factsCache.invalidate(self.remoteHost)
+                raise Exception("Cached system facts are out of date for host: %s" % (self.remoteHost))
+        return table
 
     def getAllAsicCounters(self,verbose):
-        """Get all counters from the platform"""
+        """Get all counters from the platform, returns an AsicCounterTable holding two samples and the raw output if verbose is set"""
         #itterate through the asics and the counters on the platform
-        endValues = dict()
+        table = None
         verboseOutput = []
+        if verbose:
+            sampleOutput = verboseOutput
+        else:
+            sampleOutput = None
         if self.systemFacts["product"] in ASICList:
-            asic_list = ASICList[self.systemFacts["product"]]["asic_list"]
-            qmu_list = ASICList[self.systemFacts["product"]]["qmu_list"]
-            runid = "0"
-            for asic in asic_list:
-                endValues[asic] = {}
-                for qmu in qmu_list:
-                    #Get the inital asic counters to initialize the buffer, ignore output
-                    self._getAsicCounter(asic,qmu)
-                    #Get the ASIC counters and save the output
-                    output = self._getAsicCounter(asic,qmu)
-                    lines = output.split("\n")
-                    if verbose:
-                        verboseOutput.extend(lines)
-                    queueList = BUFFERList[str(qmu)]
-                    endValues = self._compileAsicDict(endValues,asic,queueList,runid,lines)
-            runid = "1"
+            table = self.newCounterTable()
+            self.sampleAsicCounters(table,0,sampleOutput)
             #sleep for 2 seconds to grab diff of queues
             time.sleep(2)
-            for asic in asic_list:
-                for qmu in qmu_list:
-                    self._getAsicCounter(asic,qmu)
-                    output = self._getAsicCounter(asic,qmu)
-                    lines = output.split("\n")
-                    if verbose:
-                        verboseOutput.extend(lines)
-                    queueList = BUFFERList[str(qmu)]
-                    endValues = self._compileAsicDict(endValues,asic,queueList,runid,lines)
-            self.asicCounters = endValues
-        return endValues, verboseOutput
+            self.sampleAsicCounters(table,1,sampleOutput)
+            self.asicCounters = table
+        return table, verboseOutput
 
     def compareAsicCounters(self):
         """compare the two asic values"""
         finalOutput = []
-        if len(self.asicCounters) > 0:
-            for asic in self.asicCounters:
-                for queue in self.asicCounters[asic]:
-                    runid0 = ""
-                    runid1 = ""
-                    if "0" in self.asicCounters[asic][queue]:
-                        """queue initilized already"""
-                        runid0 = self.asicCounters[asic][queue]["0"]
-
-                    if "1" in self.asicCounters[asic][queue]:
-                        """queue initilized already"""
-                        runid1 = self.asicCounters[asic][queue]["1"]
-
-                    if runid1 != "" and runid0 != "":
-                        asicDiff = int(runid0,0) - int(runid1,0)
+        if self.asicCounters is not None:
+            for asic in self.asicCounters.asics:
+                for queue in self.asicCounters.queues:
+                    runid0 = self.asicCounters.get(asic,queue,0)
+                    runid1 = self.asicCounters.get(asic,queue,1)
+
+                    if runid1 is not None and runid0 is not None:
+                        asicDiff = counterDelta(runid0,runid1)
                         if asicDiff > 0:
                             if self.output:
                                 finalOutput.append("Packet loss of %d packet(s) detected in ASIC %s witin queue %s on host %s" % (asicDiff,asic,queue.rjust(6),self.systemFacts["hostname"]))
@@ -384,120 +1273,1404 @@ class NetScreenAgent:
                                 finalOutput.append("No packet loss detected in ASIC %s witin queue %s on host %s" % (asic,queue.rjust(6),self.systemFacts["hostname"]))
         return finalOutput
 
+    def counterRecords(self):
+        """Return a dict for every counter read in both samples holding the later value and the change from the first sample"""
+        records = []
+        table = self.asicCounters
+        if table is not None:
+            for asic in table.asics:
+                for queue in table.queues:
+                    first = table.get(asic,queue,0)
+                    second = table.get(asic,queue,1)
+                    if first is not None and second is not None:
+                        records.append({"host":self.remoteHost,"hostname":self.systemFacts["hostname"],"asic":asic,"queue":queue,"sample":second,"delta":counterDelta(first,second),"interval":table.times[1] - table.times[0]})
+        return records
+
+    def abort(self):
+        """Close the session without restoring paging, used when the device has stopped responding"""
+        for connection in [reader.chan for reader in self.readers[1:]] + [getattr(self,"chan",None),getattr(self,"transport",None),getattr(self,"socket",None)]:
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
     def disconnect(self):
         """Disconnect from the device"""
+        start = monotonic()
+        for reader in self.readers[1:]:
+            reader.chan.close()
         self._enablePaging()
         self.chan.close()
         self.transport.close()
         self.socket.close()
+        if self.timing is not None:
+            self.timing.phase("disconnect",start)
 
-#Main part of program
-
-#Create argument parser
-parser = argparse.ArgumentParser(description="Gather options from the user")
-parser.add_argument("---output", dest="output", action="store_true",help="Specify if you want to print output to standard out. Defaults to printing output.")
-parser.add_argument("---no-output", dest="output", action="store_false",help="Specify if you do not want to print output to standard out.")
-parser.set_defaults(output=True)
-parser.add_argument("--log",dest="log",default="",help="Specify the file name where to save the output to.")
-parser.add_argument("--log-level",dest="logLevel",default="0",metavar="LOGLEVEL",help="Specify the verbosity of logging. Default 0 provides basic logging. Setting log level to 1 provides max output.")
-parser.add_argument("--csv", dest="hostCSVFile", default="",metavar="CSVFile",help="Specify the CSV file to read hosts from.")
-parser.add_argument("--host", dest="host", default="",metavar="HOST",help="Specify single host to connect to. Can not be used with --csv.")
-parser.add_argument("--username", dest="username", default="netscreen",metavar="USERNAME",help="Specify the default username to use when not specified within the csv.")
-parser.add_argument("--password", dest="password", default="netscreen",metavar="PASSWORD",help="Specify the default password to use when not specified within the csv.")
-parser.add_argument("--password-secure", dest="passwordSecure", action="store_true", help="Be prompted for the the default password.")
-args = parser.parse_args()
-
-userPassword = ""
-verboseLogging = False
-
-#check for secure password
-if args.passwordSecure == True:
-    password = getpass.getpass()
-    userPassword = password
-else:
-    userPassword = args.password
-
-#check for logging level
-if args.logLevel == "0":
-    verboseLogging = False
-elif args.logLevel == "1":
-    verboseLogging = True
+class HostResult:
+    """
+    HostResult
 
-logger = OutputLogger(args.output,args.log)
-logger.addPrefix(socket.gethostname())
+    Holds the log output produced while polling a single host. Lines are
+    time stamped when they are recorded so they can be written out later,
+    once all of the hosts before it in the sweep have finished.
 
-if args.hostCSVFile != "": #check if singular hosts are specified
+    facts holds the system facts of the host, counters the AsicCounterTable
+    that was read, drops the total packets lost across all queues and error
+    the message of any failure. timedOut is set when the session was closed
+    because it passed its command or session deadline.
+    """
+    def __init__(self,host):
+        self.host = host
+        self.lines = []
+        self.facts = None
+        self.counters = None
+        self.drops = None
+        self.error = None
+        self.timedOut = False
+
+    def log(self,message,timestamp=False):
+        """Record a line of output for this host"""
+        self.lines.append((time.time(),message,timestamp))
+
+    def record(self,record):
+        """Record a structured record for this host"""
+        self.lines.append((time.time(),record,None))
+
+    def replay(self,logger):
+        """Write all of the recorded lines to an OutputLogger"""
+        for when,message,timestamp in self.lines:
+            if timestamp is None:
+                logger.logRecord(message,when)
+            else:
+                logger.log(message,timestamp,when)
+
+def pollHost(host,username,password,output,verbose,agentOptions=None,store=None):
+    """Connect to a host, gather and compare the ASIC counters and return a HostResult with the output
+
+    agentOptions is a dict of extra keyword arguments for NetScreenAgent. When
+    a CounterStore is given both samples are added to it. The counters are
+    compared before disconnecting, so a failure to disconnect cleanly is
+    only logged and the counters read are kept."""
+    result = HostResult(host)
+    agent = NetScreenAgent(host,username,password,output,**(agentOptions or {}))
+    if output:
+        result.log("======================================================================",True)
+        result.log("Connecting to host %s" % (host),True)
+    connected = False
+    try:
+        agent.connect()
+        connected = True
+        agent.getSystemFacts()
+        if agent.systemFacts["product"] != "":
+            if output:
+                result.log("Successfully connected to host %s" % (host),True)
+                result.log("Host: %s Product: %s Serial Number: %s" % (agent.systemFacts["hostname"],agent.systemFacts["product"],agent.systemFacts["serialNumber"]),True)
+
+            endValues, verboseOutput = agent.getAllAsicCounters(verbose)
+            result.facts = dict(agent.systemFacts)
+            result.counters = endValues
+            if store is not None and endValues is not None:
+                store.appendTable(host,endValues,0)
+                store.appendTable(host,endValues,1)
+            if len(verboseOutput) > 0:
+                for line in verboseOutput:
+                    result.log(line,True)
 
-    hp = HostParser(args.hostCSVFile)
-    if args.output:
-        if len(hp.hostList) > 1:
-            logger.log("Found %s hosts in %s CSV file. Starting stats gathering." % (len(hp.hostList),args.hostCSVFile),True)
-        elif len(hp.hostList) == 0:
-            logger.log("Found %s hosts in %s CSV file. No hosts to gather stats from." % (len(hp.hostList),args.hostCSVFile),True)
+            counters = agent.compareAsicCounters()
+            for line in counters:
+                result.log(line,True)
+            result.drops = 0
+            for record in agent.counterRecords():
+                result.drops = result.drops + record["delta"]
+                result.record(record)
+            result.log("======================================================================\n",True)
         else:
-            logger.log("Found %s hosts in %s CSV file. Starting stats gathering." % (len(hp.hostList),args.hostCSVFile),True)
+            result.error = "Failed to fetch system facts about host: %s" % (host)
+            result.log(result.error,True)
+    except Exception, e:
+        result.error = str(e)
+        result.timedOut = isinstance(e,SessionTimeout)
+        result.log(str(e))
+        agent.abort()
+        connected = False
+    finally:
+        if connected:
+            _disconnectQuietly(agent,result)
+    return result
+
+def _disconnectQuietly(agent,result):
+    """Disconnect an agent once its results are in, a failure is logged to the result and the session closed without restoring paging"""
+    try:
+        agent.disconnect()
+    except Exception, e:
+        result.log("Unable to disconnect cleanly from host %s: %s" % (agent.remoteHost,e))
+        agent.abort()
+
+def hostOptions(agentOptions,item):
+    """Return the NetScreenAgent keyword arguments for a host dict, any options of the host override agentOptions"""
+    options = item.get("options")
+    if not options:
+        return agentOptions
+    merged = dict(agentOptions or {})
+    merged.update(options)
+    return merged
+
+class FleetSweep:
+    """
+    FleetSweep
+
+    Polls hosts using a bounded pool of worker threads, each host gets its
+    own NetScreenAgent session. The output of every host is written to the
+    logger in the same order as the hosts, as soon as that host and all of
+    the hosts before it have completed.
+
+    hosts may be any iterable, including the generator returned by
+    HostParser.hosts(), and is only read as workers become free. Each host
+    is a dict containing host, username and password keys and optionally
+    an options dict of NetScreenAgent keyword arguments for that host.
+    agentOptions is a dict of extra keyword arguments for NetScreenAgent,
+    samples are added to store if a CounterStore is given. pollFunction
+    takes the same arguments as pollHost and is called to poll each host.
+    Each poll starts after a random delay of up to jitter seconds, so that
+    many workers do not log in to their hosts at the same moment. Set
+    deltas to a DeltaEngine to add the counters of every polled host to it.
+    """
+    def __init__(self,hosts,output,verbose,workers=1,agentOptions=None,store=None,pollFunction=None,jitter=0):
+        self.hosts = hosts
+        self.output = output
+        self.verbose = verbose
+        self.workers = max(1,int(workers))
+        self.agentOptions = agentOptions or {}
+        self.store = store
+        self.pollFunction = pollFunction or pollHost
+        self.jitter = jitter
+        self.deltas = None
+        self.deadlineTime = None
+        self.minimumPoll = 0
+        self.lock = threading.Lock()
+        self.total = None
+        self.completed = 0
+        self.timedOut = 0
+        self.feedError = None
+
+    def _agentOptions(self,item):
+        """Return the NetScreenAgent keyword arguments to poll a host with"""
+        return hostOptions(self.agentOptions,item)
+
+    def _worker(self,nextHost,done):
+        """Poll hosts until nextHost returns None"""
+        while True:
+            entry = nextHost()
+            if entry is None:
+                return
+            index,item = entry
+            if self.jitter > 0:
+                delay = random.uniform(0,self.jitter)
+                if self.deadlineTime is not None:
+                    #still leave the poll time to finish before the deadline
+                    delay = min(delay,max(0,self.deadlineTime - self.minimumPoll - monotonic()))
+                time.sleep(delay)
+            try:
+                result = self.pollFunction(item["host"],item["username"],item["password"],self.output,self.verbose,self._agentOptions(item),self.store)
+            except Exception, e:
+                result = HostResult(item["host"])
+                result.log(str(e))
+            self._finished(item,result)
+            done.put((index,result))
+
+    def _finished(self,item,result):
+        """Called by a worker when a host has been polled, before its result is passed on"""
+        pass
+
+    def _startWorkers(self,nextHost,done):
+        """Start workers threads polling the hosts returned by nextHost, returns the threads"""
+        threads = []
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._worker,args=(nextHost,done))
+            worker.daemon = True
+            worker.start()
+            threads.append(worker)
+        return threads
+
+    def _hostFeed(self,done):
+        """Return a function handing out the next (index, host), or None once every host has been handed out"""
+        entries = enumerate(self.hosts)
+        count = [0]
+        def nextHost():
+            with self.lock:
+                if self.total is not None:
+                    return None
+                try:
+                    entry = entries.next()
+                except StopIteration:
+                    self.total = count[0]
+                    return None
+                except Exception, e:
+                    #stop the sweep if the hosts can not be read, run() raises the error
+                    self.feedError = e
+                    self.total = count[0]
+                    return None
+                count[0] = count[0] + 1
+                return entry
+        return nextHost
+
+    def _replayFinished(self,finished,results,logger):
+        """Write out every finished result that all of the hosts before it are waiting on"""
+        while self.completed in finished:
+            result = finished.pop(self.completed)
+            if result.timedOut:
+                self.timedOut = self.timedOut + 1
+            result.replay(logger)
+            if self.deltas is not None:
+                self.deltas.addResult(result)
+            if results is not None:
+                results.append(result)
+            self.completed = self.completed + 1
+
+    def run(self,logger,keepResults=True):
+        """Poll all hosts and write the results to the logger, returns the list of HostResults in host order
+
+        With keepResults false each result is dropped once it has been
+        written, so memory does not grow with the number of hosts, and None
+        is returned. completed holds the number of hosts polled and timedOut
+        the number of those whose session timed out."""
+        self.total = None
+        self.completed = 0
+        self.timedOut = 0
+        self.feedError = None
+        done = Queue.Queue()
+        self._startWorkers(self._hostFeed(done),done)
+
+        finished = {}
+        results = None
+        if keepResults:
+            results = []
+        while self.total is None or self.completed < self.total:
+            try:
+                #use a timeout so the main thread still sees keyboard interrupts
+                index,result = done.get(True,1)
+            except Queue.Empty:
+                continue
+            finished[index] = result
+            self._replayFinished(finished,results,logger)
+        if self.feedError is not None:
+            raise self.feedError
+        return results
+
+class ShardedSweep(FleetSweep):
+    """
+    ShardedSweep
+
+    Polls hosts like FleetSweep but hands them out to a number of worker
+    processes, each running its own pool of workers threads, so the SSH
+    work of a large inventory is spread over several CPU cores. Hosts are
+    read and passed on as the workers take them, and each HostResult is
+    sent back to this process as soon as its host is done and written to
+    the logger in host order.
+
+    Facts cache entries and session timings gathered in the worker
+    processes are merged into the FactsCache and TimingReport in
+    agentOptions when each process finishes. Hosts that were handed to a
+    worker process that died are reported as failed.
+    """
+    def __init__(self,hosts,output,verbose,workers=1,agentOptions=None,store=None,pollFunction=None,processes=2,jitter=0):
+        FleetSweep.__init__(self,hosts,output,verbose,workers,agentOptions,store,pollFunction,jitter)
+        self.processes = max(1,int(processes))
+
+    def _runShard(self,pending,done):
+        """Poll hosts from the pending queue in a worker process, then send back the state gathered by it"""
+        import signal
+        #interrupts are handled by the parent process, which stops the workers
+        signal.signal(signal.SIGINT,signal.SIG_IGN)
+        polled = []
+        def nextHost():
+            entry = pending.get()
+            if entry is None:
+                #leave the end marker for the other workers
+                pending.put(None)
+                return None
+            polled.append(entry[1]["host"])
+            return entry
+        for worker in self._startWorkers(nextHost,done):
+            worker.join()
+        state = {}
+        factsCache = self.agentOptions.get("factsCache")
+        if factsCache is not None:
+            state["facts"] = factsCache.export(polled)
+        timing = self.agentOptions.get("timing")
+        if timing is not None:
+            state["timing"] = timing.sessions
+        done.put((None,state))
+
+    def _feed(self,pending,outstanding,stopFeed):
+        """Put the hosts on the pending queue as the workers take them, runs on its own thread"""
+        count = 0
+        try:
+            for index,item in enumerate(self.hosts):
+                with self.lock:
+                    outstanding[index] = item
+                count = index + 1
+                while not stopFeed.is_set():
+                    try:
+                        pending.put((index,item),True,1)
+                        break
+                    except Queue.Full:
+                        continue
+        except Exception, e:
+            self.feedError = e
+        with self.lock:
+            self.total = count
+        pending.put(None)
+
+    def _mergeShard(self,state):
+        """Merge the state sent back by a finished worker process"""
+        if "facts" in state:
+            self.agentOptions["factsCache"].merge(state["facts"])
+        if "timing" in state:
+            self.agentOptions["timing"].addSessions(state["timing"])
+
+    def run(self,logger,keepResults=True):
+        """Poll all hosts and write the results to the logger, returns the list of HostResults in host order, see FleetSweep.run()"""
+        import multiprocessing
+        self.total = None
+        self.completed = 0
+        self.timedOut = 0
+        self.feedError = None
+        pending = multiprocessing.Queue(self.processes * self.workers * 2)
+        done = multiprocessing.Queue()
+        outstanding = {}
+        stopFeed = threading.Event()
+        processes = []
+        finished = {}
+        results = None
+        if keepResults:
+            results = []
+        try:
+            for i in range(self.processes):
+                process = multiprocessing.Process(target=self._runShard,args=(pending,done))
+                process.daemon = True
+                process.start()
+                processes.append(process)
+            feeder = threading.Thread(target=self._feed,args=(pending,outstanding,stopFeed))
+            feeder.daemon = True
+            feeder.start()
+
+            running = len(processes)
+            while self.total is None or self.completed < self.total or running > 0:
+                try:
+                    index,result = done.get(True,1)
+                except Queue.Empty:
+                    if len([process for process in processes if process.is_alive()]) == 0:
+                        #the worker processes died without finishing their hosts
+                        stopFeed.set()
+                        feeder.join()
+                        for index,item in outstanding.items():
+                            if index not in finished:
+                                finished[index] = HostResult(item["host"])
+                                finished[index].error = "Worker process exited before polling host: %s" % (item["host"])
+                                finished[index].log(finished[index].error)
+                        outstanding.clear()
+                        self._replayFinished(finished,results,logger)
+                        running = 0
+                    continue
+                if index is None:
+                    self._mergeShard(result)
+                    running = running - 1
+                    continue
+                with self.lock:
+                    outstanding.pop(index,None)
+                finished[index] = result
+                self._replayFinished(finished,results,logger)
+        finally:
+            stopFeed.set()
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+        if self.feedError is not None:
+            raise self.feedError
+        return results
+
+class DeadlineSweep(FleetSweep):
+    """
+    DeadlineSweep
+
+    Polls hosts like FleetSweep but stops starting new polls once deadline
+    seconds have passed, so a sweep finishes in a known time. Hosts that
+    had not been started by then are reported as skipped.
+
+    Once every host has been polled the time left is spent polling hosts
+    again. A host that lost packets is due again lossyInterval seconds
+    after its last poll finished and any other host after quietInterval
+    seconds, or never if quietInterval is None. Due hosts are taken from a
+    heap ordered by the time they are due and then by the packets they
+    lost, so the lossiest hosts go first when the workers are busy. Every
+    poll is written out as its own result, in the order they started. A
+    session still running at the deadline is closed and reported as timed
+    out.
+
+    No poll is started once less than minimumPoll seconds are left before
+    the deadline, as it could not finish in time. A poll by pollHost takes
+    at least the 2 seconds between its samples.
+    """
+    def __init__(self,hosts,output,verbose,workers=1,agentOptions=None,store=None,pollFunction=None,jitter=0,deadline=300,lossyInterval=30,quietInterval=None,minimumPoll=3):
+        FleetSweep.__init__(self,hosts,output,verbose,workers,agentOptions,store,pollFunction,jitter)
+        self.deadline = deadline
+        self.lossyInterval = lossyInterval
+        self.quietInterval = quietInterval
+        self.minimumPoll = minimumPoll
+        self.condition = threading.Condition(self.lock)
+        self.revisits = []
+        self.started = 0
+        self.scheduled = 0
+        self.running = 0
+        self.revisited = 0
+        self.skipped = 0
+
+    def _finished(self,item,result):
+        """Schedule the next poll of a host"""
+        with self.condition:
+            self.running = self.running - 1
+            interval = self.quietInterval
+            if result.drops:
+                interval = self.lossyInterval
+            if interval is not None:
+                #the count keeps hosts due at the same time in the order they finished
+                heapq.heappush(self.revisits,(monotonic() + interval,-(result.drops or 0),self.scheduled,item))
+                self.scheduled = self.scheduled + 1
+            self.condition.notify_all()
+
+    def _agentOptions(self,item):
+        """Limit the session of a host, from the start of connecting, to the time left before the deadline"""
+        options = dict(FleetSweep._agentOptions(self,item) or {})
+        remaining = max(0,self.deadlineTime - monotonic())
+        if options.get("sessionTimeout") is None or options["sessionTimeout"] > remaining:
+            options["sessionTimeout"] = remaining
+        if options.get("connectTimeout",15) > remaining:
+            options["connectTimeout"] = remaining
+        return options
+
+    def _start(self,item):
+        self.running = self.running + 1
+        self.started = self.started + 1
+        return (self.started - 1,item)
+
+    def _skipRemaining(self,entries,done):
+        """Report every host not yet read from the host list as skipped"""
+        try:
+            for index,item in entries:
+                result = HostResult(item["host"])
+                result.error = "Deadline reached before polling host: %s" % (item["host"])
+                result.log(result.error,True)
+                done.put((self.started,result))
+                self.started = self.started + 1
+                self.skipped = self.skipped + 1
+        except Exception, e:
+            self.feedError = e
+
+    def _hostFeed(self,done):
+        """Return a function handing out the next host that is due, or None once the deadline has passed or no host is left"""
+        entries = enumerate(self.hosts)
+        exhausted = [False]
+        lastStart = self.deadlineTime - self.minimumPoll
+        def nextHost():
+            with self.condition:
+                while True:
+                    if self.total is not None:
+                        return None
+                    now = monotonic()
+                    if now >= lastStart:
+                        if not exhausted[0]:
+                            self._skipRemaining(entries,done)
+                            exhausted[0] = True
+                        self.total = self.started
+                        self.condition.notify_all()
+                        return None
+                    if not exhausted[0]:
+                        try:
+                            index,item = entries.next()
+                            return self._start(item)
+                        except StopIteration:
+                            exhausted[0] = True
+                        except Exception, e:
+                            self.feedError = e
+                            self.total = self.started
+                            self.condition.notify_all()
+                            return None
+                    if len(self.revisits) > 0 and self.revisits[0][0] <= now:
+                        due,priority,order,item = heapq.heappop(self.revisits)
+                        self.revisited = self.revisited + 1
+                        return self._start(item)
+                    if len(self.revisits) == 0 and self.running == 0:
+                        #nothing is due and no running poll can schedule another
+                        self.total = self.started
+                        self.condition.notify_all()
+                        return None
+                    wake = lastStart
+                    if len(self.revisits) > 0:
+                        wake = min(wake,self.revisits[0][0])
+                    self.condition.wait(min(1,max(0.01,wake - now)))
+        return nextHost
+
+    def run(self,logger,keepResults=True):
+        """Poll hosts until the deadline and write the results to the logger, see FleetSweep.run()"""
+        self.deadlineTime = monotonic() + self.deadline
+        self.revisits = []
+        self.started = 0
+        self.scheduled = 0
+        self.running = 0
+        self.revisited = 0
+        self.skipped = 0
+        return FleetSweep.run(self,logger,keepResults)
+
+def shardHosts(hosts,index,count):
+    """Generate the hosts that belong to shard index of count, every host is always placed in the same shard"""
+    for item in hosts:
+        if (zlib.crc32(item["host"]) & 0xFFFFFFFF) % count == index:
+            yield item
+
+def sweep(hosts,username="netscreen",password="netscreen",logger=None,workers=1,verbose=False,agentOptions=None,store=None):
+    """Poll a list of hosts and return a HostResult for each, in the same order
+
+    hosts may contain host names or dicts as returned by HostParser.getHosts(),
+    username and password are used for any host without its own. Output is
+    written to logger if one is given, otherwise the results are only
+    returned."""
+    items = []
+    for host in hosts:
+        if isinstance(host,dict):
+            item = dict(host)
+        else:
+            item = {"host":host,"username":"","password":""}
+        if item.get("username","") == "":
+            item["username"] = username
+        if item.get("password","") == "":
+            item["password"] = password
+        items.append(item)
+    if logger is None:
+        logger = OutputLogger(False)
+    return FleetSweep(items,True,verbose,workers,agentOptions,store).run(logger)
+
+class BurstDetector:
+    """
+    BurstDetector
+
+    Finds significant jumps in the drop rate of a stream of counter deltas.
+    For every key, normally a (host, asic, queue), it keeps an exponentially
+    weighted moving average of the drop rate and of its variance, the time
+    the key was last seen and the state of any open alert, so memory does
+    not grow with the number of samples.
+
+    A burst starts once at least warmup samples have been seen and the drop
+    rate is more than threshold standard deviations and at least minRate
+    packets per second above the average. It ends at the first sample back
+    under that level, the average is not updated while a burst is open.
+    Queues that always drop a few packets raise their own
+    average and only alert when they drop markedly more than usual.
+    """
+    def __init__(self,alpha=0.05,threshold=4.0,warmup=10,minRate=1.0):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        self.minRate = minRate
+        #key: [mean, variance, samples, last seen, alert start, alert drops, alert peak rate]
+        self.state = {}
+
+    def observe(self,key,timestamp,drops,interval):
+        """Add the drops of a key over interval seconds ending at timestamp, returns a burst_start or burst_end event dict or None"""
+        if interval <= 0:
+            return None
+        rate = drops / float(interval)
+        state = self.state.get(key)
+        if state is None:
+            state = [rate,0.0,0,timestamp,None,0,0.0]
+            self.state[key] = state
+        mean,variance,samples = state[0],state[1],state[2]
+        if samples > 0:
+            #the variance starts from zero, scale it up while it has only seen a few samples
+            variance = variance / (1 - (1 - self.alpha) ** samples)
+        limit = mean + max(self.threshold * variance ** 0.5,self.minRate)
+        event = None
+        if state[4] is None:
+            if samples >= self.warmup and rate > limit:
+                state[4] = timestamp - interval
+                state[5] = drops
+                state[6] = rate
+                event = {"event":"burst_start","time":timestamp,"rate":rate,"baseline":mean,"deviation":variance ** 0.5,"drops":drops}
+        elif rate > limit:
+            state[5] = state[5] + drops
+            state[6] = max(state[6],rate)
+        else:
+            event = {"event":"burst_end","time":timestamp,"rate":rate,"baseline":mean,"duration":timestamp - state[4],"drops":state[5],"peakRate":state[6]}
+            state[4] = None
+        if state[4] is None:
+            #the average is held while a burst is open so it is not raised by the burst
+            difference = rate - mean
+            increment = self.alpha * difference
+            state[0] = mean + increment
+            state[1] = (1 - self.alpha) * (state[1] + difference * increment)
+            state[2] = samples + 1
+        state[3] = timestamp
+        return event
+
+    def expire(self,olderThan):
+        """Forget every key last seen before olderThan, returns the number of keys removed"""
+        stale = [key for key,state in self.state.items() if state[3] < olderThan]
+        for key in stale:
+            del self.state[key]
+        return len(stale)
+
+class ContinuousMonitor:
+    """
+    ContinuousMonitor
 
-    for item in hp.getHosts():
-        if item["username"] == "":
-            item["username"] = args.username
+    Keeps a single NetScreenAgent session open to a host and samples the
+    ASIC counters every interval seconds. The change in each counter since
+    the previous sample is written to the logger as soon as it is read.
 
-        if item["password"] == "":
-            item["password"] = userPassword
+    If the session drops the monitor reconnects, waiting twice as long after
+    each failed attempt up to maxBackoff seconds. agentOptions is a dict of
+    extra keyword arguments for NetScreenAgent, every sample is added to
+    store if a CounterStore is given and to metrics if a MetricsCache is
+    given.
 
-        #Add local hostname to the log
+    With a BurstDetector only the start and end of significant bursts are
+    reported, the loss in every interval is only logged when verbose.
+    """
+    def __init__(self,host,username,password,interval,logger,output,verbose,maxBackoff=300,agentOptions=None,store=None,metrics=None,detector=None):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.interval = float(interval)
+        self.logger = logger
+        self.output = output
+        self.verbose = verbose
+        self.maxBackoff = maxBackoff
+        self.agentOptions = agentOptions or {}
+        self.store = store
+        self.metrics = metrics
+        self.detector = detector
+        self.agent = None
+        self.stopEvent = threading.Event()
 
-        agent = NetScreenAgent(item["host"],item["username"],item["password"],args.output)
-        if args.output:
-            logger.log("======================================================================",True)
-            logger.log("Connecting to host %s" % (item["host"]),True)
-        try:
-            agent.connect()
-            agent.getSystemFacts()
-            if agent.systemFacts["product"] != "":
-                if args.output:
-                    logger.log("Successfully connected to host %s" % (item["host"]),True)
-                    logger.log("Host: %s Product: %s Serial Number: %s" % (agent.systemFacts["hostname"],agent.systemFacts["product"],agent.systemFacts["serialNumber"]),True)
-                endValues, verboseOutput = agent.getAllAsicCounters(verboseLogging)
-                if len(verboseOutput) > 0:
-                    for line in verboseOutput:
-                        logger.log(line,True)
-
-                agent.disconnect()
-                counters = agent.compareAsicCounters()
-                for line in counters:
-                    logger.log(line,True)
-                logger.log("======================================================================\n",True)
+    def stop(self):
+        """Ask the monitor to finish after the current sample"""
+        self.stopEvent.set()
+
+    def _connect(self):
+        """Open the session and gather the system facts"""
+        #the session is kept open so only the command timeout applies
+        options = dict(self.agentOptions)
+        options.pop("sessionTimeout",None)
+        self.agent = NetScreenAgent(self.host,self.username,self.password,self.output,**options)
+        self.agent.connect()
+        self.agent.getSystemFacts()
+        if self.agent.systemFacts["product"] not in ASICList:
+            raise Exception("Unsupported product %s on host: %s" % (self.agent.systemFacts["product"],self.host))
+        if self.output:
+            self.logger.log("Monitoring host %s Product: %s Serial Number: %s every %s seconds" % (self.agent.systemFacts["hostname"],self.agent.systemFacts["product"],self.agent.systemFacts["serialNumber"],self.interval),True)
+
+    def _close(self):
+        """Tear down the session, ignoring any errors from a session that has already dropped"""
+        if self.agent is not None:
+            try:
+                self.agent.disconnect()
+            except Exception:
+                self.agent.abort()
+            self.agent = None
+
+    def _logDeltas(self,table,previous,current):
+        """Log the change of each counter between two samples in the table"""
+        hostname = self.agent.systemFacts["hostname"]
+        elapsed = table.times[current] - table.times[previous]
+        for asic in table.asics:
+            for queue in table.queues:
+                first = table.get(asic,queue,previous)
+                second = table.get(asic,queue,current)
+                if first is None or second is None:
+                    continue
+                delta = counterDelta(first,second)
+                self.logger.logRecord({"host":self.host,"hostname":hostname,"asic":asic,"queue":queue,"sample":second,"delta":delta,"interval":elapsed})
+                if self.detector is not None:
+                    event = self.detector.observe((self.host,asic,queue),table.times[current],delta,elapsed)
+                    if event is not None:
+                        self._logBurst(event,hostname,asic,queue)
+                    if not self.verbose:
+                        continue
+                if delta > 0:
+                    self.logger.log("Packet loss of %d packet(s) detected in ASIC %s within queue %s on host %s in the last %.1f seconds" % (delta,asic,queue.rjust(6),hostname,elapsed),True)
+                elif self.verbose:
+                    self.logger.log("No packet loss detected in ASIC %s within queue %s on host %s in the last %.1f seconds" % (asic,queue.rjust(6),hostname,elapsed),True)
+
+    def _logBurst(self,event,hostname,asic,queue):
+        """Log a burst_start or burst_end event from the BurstDetector"""
+        event.update({"host":self.host,"hostname":hostname,"asic":asic,"queue":queue})
+        self.logger.logRecord(event)
+        if event["event"] == "burst_start":
+            self.logger.log("Burst started in ASIC %s within queue %s on host %s, %.1f packets per second against a usual %.1f" % (asic,queue.rjust(6),hostname,event["rate"],event["baseline"]),True)
+        else:
+            self.logger.log("Burst ended in ASIC %s within queue %s on host %s after %.1f seconds, %d packet(s) dropped at up to %.1f packets per second" % (asic,queue.rjust(6),hostname,event["duration"],event["drops"],event["peakRate"]),True)
+
+    def run(self):
+        """Sample the host until stop() is called"""
+        backoff = 1
+        table = None
+        current = 0
+        while not self.stopEvent.is_set():
+            try:
+                if self.agent is None:
+                    self._connect()
+                    table = None
+                if table is None:
+                    #two samples are kept, each new sample replaces the oldest
+                    table = self.agent.newCounterTable(2)
+                    current = 0
+                    self.agent.sampleAsicCounters(table,current)
+                    previous = None
+                else:
+                    current = 1 - current
+                    previous = 1 - current
+                    self.agent.sampleAsicCounters(table,current)
+                    self._logDeltas(table,previous,current)
+                if self.store is not None:
+                    self.store.appendTable(self.host,table,current)
+                if self.metrics is not None:
+                    self.metrics.update(self.host,self.agent.systemFacts,table,current,previous)
+                backoff = 1
+                self.stopEvent.wait(max(0,self.interval - (time.time() - table.times[current])))
+            except Exception, e:
+                self.logger.log("%s, reconnecting in %s seconds" % (str(e),backoff),True)
+                if self.metrics is not None:
+                    self.metrics.markDown(self.host)
+                self._close()
+                self.stopEvent.wait(backoff)
+                backoff = min(backoff * 2,self.maxBackoff)
+        self._close()
+
+class HighRateSampler:
+    """
+    HighRateSampler
+
+    Reads a chosen subset of the queues of a connected device in a tight
+    loop for duration seconds, to place bursts more precisely than a pair
+    of samples taken 2 seconds apart. Queues are selected with shell style
+    patterns such as XMT*, optionally limited to some QMUs and ASICs, and
+    only the commands covering those queues are sent. Every sample is time
+    stamped with the monotonic time its prompt arrived.
+
+    After run(), series maps each (asic, queue) to a list of
+    (timestamp, value) samples. The intervals between samples are a few
+    milliseconds long and vary in length, so the peak is not taken from
+    their rates: the drops of each interval are added to the window of
+    window seconds, counted from the start of the run, in which the
+    interval ended, and the window with the most drops is reported.
+    """
+    def __init__(self,agent,queuePatterns,qmus=None,asics=None,duration=10,window=0.1):
+        self.agent = agent
+        self.queuePatterns = queuePatterns
+        self.qmus = qmus
+        self.asics = asics
+        self.duration = duration
+        self.window = window
+        self.plan = None
+        self.series = {}
+        self.startWall = 0
+        self.startMonotonic = 0
+
+    def _plan(self):
+        """Look up the PollPlan of the commands to read on every pass"""
+        self.plan = pollPlan(self.agent.systemFacts["product"],self.queuePatterns,self.qmus,self.asics)
+        if self.plan is None or len(self.plan.commands) == 0:
+            raise Exception("No queues match %s on host: %s" % (",".join(self.queuePatterns),self.agent.remoteHost))
+        for cell in self.plan.cells:
+            self.series[cell] = []
+
+    def run(self):
+        """Sample the selected queues until the duration has passed, returns the number of passes"""
+        self._plan()
+        steps = zip(self.plan.commands,self.plan.parseMap)
+        seriesList = [self.series[cell] for cell in self.plan.cells]
+        self.startWall = time.time()
+        self.startMonotonic = monotonic()
+        passes = 0
+        while monotonic() - self.startMonotonic < self.duration:
+            for command,cells in steps:
+                output = self.agent.runCommand(command)
+                timestamp = self.agent.reader.promptTime
+                for match in AsicCounterTable.pktcntRE.finditer(output):
+                    cell = cells.get(match.group(1))
+                    if cell is not None:
+                        seriesList[cell].append((timestamp,int(match.group(2),16)))
+            passes = passes + 1
+        return passes
+
+    def wallTime(self,timestamp):
+        """Convert a monotonic sample time to a datetime"""
+        return datetime.datetime.fromtimestamp(self.startWall + timestamp - self.startMonotonic)
+
+    def intervals(self,asic,queue):
+        """Return (start, end, drops, drops per second) for each interval between samples of a queue"""
+        result = []
+        samples = self.series[(asic,queue)]
+        for index in range(1,len(samples)):
+            start,first = samples[index - 1]
+            end,second = samples[index]
+            drops = counterDelta(first,second)
+            if end > start:
+                result.append((start,end,drops,drops / (end - start)))
             else:
-                logger.log("Failed to fetch system facts about host: %s" % (item["host"]),True)
-        except Exception, e:
-            logger.log(str(e))
-elif args.host != "":
-    agent = NetScreenAgent(args.host,args.username,userPassword,args.output)
-    if args.output:
-        logger.log("======================================================================",True)
-        logger.log("Connecting to host %s" % (args.host),True)
+                result.append((start,end,drops,0.0))
+        return result
+
+    def windows(self,asic,queue):
+        """Return (start, end, drops) for each window of a queue that dropped packets, in time order"""
+        totals = {}
+        for start,end,drops,rate in self.intervals(asic,queue):
+            if drops > 0:
+                index = int((end - self.startMonotonic) // self.window)
+                totals[index] = totals.get(index,0) + drops
+        return [(self.startMonotonic + index * self.window,self.startMonotonic + (index + 1) * self.window,drops) for index,drops in sorted(totals.items())]
+
+    def report(self,verbose):
+        """Return the report lines: drops per queue, every lossy interval when verbose and the peak interval"""
+        lines = []
+        hostname = self.agent.systemFacts["hostname"]
+        peak = None
+        for asic,queue in sorted(self.series):
+            intervals = self.intervals(asic,queue)
+            if len(intervals) == 0:
+                continue
+            spacing = (intervals[-1][1] - intervals[0][0]) / len(intervals)
+            total = sum([drops for start,end,drops,rate in intervals])
+            if total > 0:
+                lines.append("Packet loss of %d packet(s) detected in ASIC %s within queue %s on host %s over %d samples %.0fms apart" % (total,asic,queue.rjust(6),hostname,len(intervals) + 1,spacing * 1000))
+            elif verbose:
+                lines.append("No packet loss detected in ASIC %s within queue %s on host %s over %d samples %.0fms apart" % (asic,queue.rjust(6),hostname,len(intervals) + 1,spacing * 1000))
+            for start,end,drops,rate in intervals:
+                if drops > 0 and verbose:
+                    lines.append("%s Packet loss of %d packet(s) in ASIC %s within queue %s on host %s over %.0fms, %.0f packets per second" % (self.wallTime(end).isoformat(),drops,asic,queue.rjust(6),hostname,(end - start) * 1000,rate))
+            for start,end,drops in self.windows(asic,queue):
+                if peak is None or drops > peak[4]:
+                    peak = (asic,queue,start,end,drops)
+        if peak is not None:
+            asic,queue,start,end,drops = peak
+            lines.append("Peak packet loss of %d packet(s) in ASIC %s within queue %s on host %s in the %.0fms between %s and %s, %.0f packets per second" % (drops,asic,queue.rjust(6),hostname,self.window * 1000,self.wallTime(start).isoformat(),self.wallTime(end).isoformat(),drops / self.window))
+        else:
+            lines.append("No packet loss detected on host %s" % (hostname))
+        return lines
+
+def pollHostHighRate(host,username,password,output,verbose,agentOptions=None,store=None,queuePatterns=None,qmus=None,asics=None,duration=10,window=0.1):
+    """Connect to a host, run a HighRateSampler and return a HostResult with the report"""
+    result = HostResult(host)
+    agent = NetScreenAgent(host,username,password,output,**(agentOptions or {}))
+    if output:
+        result.log("======================================================================",True)
+        result.log("Connecting to host %s" % (host),True)
+    connected = False
     try:
         agent.connect()
+        connected = True
         agent.getSystemFacts()
-        if agent.systemFacts["product"] != "":
-            if args.output:
-                logger.log("Successfully connected to host %s" % (args.host),True)
-                logger.log("Host: %s Product: %s Serial Number: %s" % (agent.systemFacts["hostname"],agent.systemFacts["product"],agent.systemFacts["serialNumber"]),True)
+        if agent.systemFacts["product"] in ASICList:
+            if output:
+                result.log("Successfully connected to host %s" % (host),True)
+                result.log("Host: %s Product: %s Serial Number: %s" % (agent.systemFacts["hostname"],agent.systemFacts["product"],agent.systemFacts["serialNumber"]),True)
+            sampler = HighRateSampler(agent,queuePatterns or ["*"],qmus,asics,duration,window)
+            passes = sampler.run()
+            if store is not None:
+                for (asic,queue),samples in sampler.series.items():
+                    store.appendMany(host,[(asic,queue,sampler.startWall + timestamp - sampler.startMonotonic,value) for timestamp,value in samples])
+            result.drops = sum([drops for asic,queue in sampler.series for start,end,drops,rate in sampler.intervals(asic,queue)])
+            result.log("Sampled %s queue(s) %s times in %s seconds on host %s" % (len(sampler.series),passes,duration,host),True)
+            for line in sampler.report(verbose):
+                result.log(line,True)
+            result.log("======================================================================\n",True)
+        else:
+            result.log("Failed to fetch system facts about host: %s" % (host),True)
+    except Exception, e:
+        result.error = str(e)
+        result.timedOut = isinstance(e,SessionTimeout)
+        result.log(str(e))
+        agent.abort()
+        connected = False
+    finally:
+        if connected:
+            _disconnectQuietly(agent,result)
+    return result
+
+class DeltaEngine:
+    """
+    DeltaEngine
+
+    Works out the change in the counters of a whole fleet at once. The two
+    samples of each host's AsicCounterTable are copied into NumPy arrays
+    when the host is added, and compute() joins them into flat arrays with
+    one entry per (host, asic, queue), so the wrap corrected deltas, the
+    rates and the fleet wide totals take a few array operations instead of
+    a Python loop per counter.
+
+    Adding a host again replaces its earlier samples, so a host polled
+    more than once in a sweep is counted once with its latest poll. numpy
+    is only needed once an engine is created.
+    """
+    #XMT1-d, CPU2-d and L2Q-d are of type XMT, CPU and L2Q
+    queueTypeRE = re.compile("\d*-d$")
 
-            endValues, verboseOutput = agent.getAllAsicCounters(verboseLogging)
-            if len(verboseOutput) > 0:
-                for line in verboseOutput:
-                    logger.log(line,True)
+    def __init__(self):
+        try:
+            import numpy
+        except ImportError:
+            raise Exception("The numpy module is needed to compare the counters of many hosts, install it with pip install numpy")
+        self.numpy = numpy
+        self.hosts = {}
+        self.productNames = []
+        self.productIndex = {}
+        self.queueNames = []
+        self.queueIndex = {}
+        self.compute()
+
+    def _index(self,names,index,name):
+        if name not in index:
+            index[name] = len(names)
+            names.append(name)
+        return index[name]
+
+    def addTable(self,host,product,table,first=0,second=1):
+        """Add the counters read in both samples of an AsicCounterTable for a host"""
+        numpy = self.numpy
+        cells = len(table.asics) * len(table.queues)
+        values = numpy.frombuffer(table.values,dtype="u%s" % (table.values.itemsize)).reshape(cells,table.samples)
+        present = numpy.frombuffer(table.present,dtype=numpy.uint8).reshape(cells,table.samples)
+        read = (present[:,first] != 0) & (present[:,second] != 0)
+        queues = numpy.array([self._index(self.queueNames,self.queueIndex,queue) for queue in table.queues],dtype=numpy.int32)
+        self.hosts[host] = {
+            "product":self._index(self.productNames,self.productIndex,product),
+            "asic":numpy.repeat(numpy.array(table.asics,dtype=numpy.int32),len(queues))[read],
+            "queue":numpy.tile(queues,len(table.asics))[read],
+            "first":values[read,first].astype(numpy.uint64),
+            "second":values[read,second].astype(numpy.uint64),
+            "interval":table.times[second] - table.times[first]}
+
+    def addResult(self,result):
+        """Add the counters of a HostResult from pollHost, results without counters are ignored"""
+        if result.counters is not None and result.facts is not None:
+            self.addTable(result.host,result.facts["product"],result.counters)
+
+    def compute(self):
+        """Join the samples of every host and work out the deltas and rates, returns the number of counters
+
+        This is the array form of counterDelta(), the change is taken
+        modulo 2**32 and a counter that wrapped between the samples still
+        gives the packets counted in between."""
+        numpy = self.numpy
+        self.hostNames = sorted(self.hosts)
+        parts = [self.hosts[host] for host in self.hostNames]
+        def join(name,dtype):
+            return numpy.concatenate([numpy.zeros(0,dtype=dtype)] + [part[name] for part in parts])
+        sizes = [len(part["asic"]) for part in parts]
+        self.host = numpy.repeat(numpy.arange(len(parts),dtype=numpy.int32),sizes)
+        self.hostProduct = numpy.array([part["product"] for part in parts],dtype=numpy.int32)
+        self.product = self.hostProduct[self.host]
+        self.asic = join("asic",numpy.int32)
+        self.queue = join("queue",numpy.int32)
+        self.delta = (join("second",numpy.uint64) - join("first",numpy.uint64)) & numpy.uint64(0xFFFFFFFF)
+        interval = numpy.repeat(numpy.array([part["interval"] for part in parts],dtype=numpy.float64),sizes)
+        self.rate = numpy.zeros(len(self.delta))
+        timed = interval > 0
+        self.rate[timed] = self.delta[timed] / interval[timed]
+        return len(self.delta)
+
+    def top(self,count):
+        """Return up to count of the queues that lost the most packets, largest first, as dicts"""
+        numpy = self.numpy
+        if count <= 0:
+            return []
+        lossy = numpy.flatnonzero(self.delta)
+        if count < len(lossy):
+            lossy = lossy[numpy.argpartition(self.delta[lossy],len(lossy) - count)[len(lossy) - count:]]
+        lossy = lossy[numpy.argsort(self.delta[lossy],kind="mergesort")[::-1]]
+        return [{"host":self.hostNames[self.host[index]],"product":self.productNames[self.product[index]],"asic":int(self.asic[index]),"queue":self.queueNames[self.queue[index]],"delta":int(self.delta[index]),"rate":float(self.rate[index])} for index in lossy]
+
+    def productTotals(self):
+        """Return a dict of product name to the number of hosts and the packets lost by them"""
+        numpy = self.numpy
+        hosts = numpy.bincount(self.hostProduct,minlength=len(self.productNames))
+        drops = numpy.bincount(self.product,weights=self.delta,minlength=len(self.productNames))
+        return dict([(name,{"hosts":int(hosts[index]),"drops":int(drops[index])}) for index,name in enumerate(self.productNames) if hosts[index] > 0])
+
+    def queueTypeTotals(self):
+        """Return a dict of queue type, such as XMT or CPU, to the number of queues of that type read and the packets lost by them"""
+        numpy = self.numpy
+        types = []
+        typeIndex = {}
+        queueType = numpy.array([self._index(types,typeIndex,self.queueTypeRE.sub("",queue)) for queue in self.queueNames],dtype=numpy.int32)
+        counterType = queueType[self.queue]
+        queues = numpy.bincount(counterType,minlength=len(types))
+        drops = numpy.bincount(counterType,weights=self.delta,minlength=len(types))
+        return dict([(name,{"queues":int(queues[index]),"drops":int(drops[index])}) for index,name in enumerate(types) if queues[index] > 0])
+
+    def summary(self,count=10):
+        """Compute the deltas and return the top count lossy queues and the fleet totals as a dict"""
+        self.compute()
+        return {"hosts":len(self.hostNames),"counters":len(self.delta),"drops":int(self.delta.sum()),"top":self.top(count),"products":self.productTotals(),"queueTypes":self.queueTypeTotals()}
+
+    def summaryLines(self,summary):
+        """Return a summary as lines of text"""
+        lines = ["Fleet summary: %s packet(s) lost across %s queues on %s hosts" % (summary["drops"],summary["counters"],summary["hosts"])]
+        for entry in summary["top"]:
+            lines.append("Fleet summary: %s packet(s) lost, %.1f per second, in ASIC %s queue %s on host %s (%s)" % (entry["delta"],entry["rate"],entry["asic"],entry["queue"].rjust(6),entry["host"],entry["product"]))
+        for name,totals in sorted(summary["products"].items()):
+            lines.append("Fleet summary: %s packet(s) lost on %s %s hosts" % (totals["drops"],totals["hosts"],name))
+        for name,totals in sorted(summary["queueTypes"].items()):
+            lines.append("Fleet summary: %s packet(s) lost in %s %s queues" % (totals["drops"],totals["queues"],name))
+        return lines
+
+class MetricsCache:
+    """
+    MetricsCache
+
+    Holds the latest counters of every monitored host and renders them in
+    the Prometheus text format. Each host's metrics are rendered when its
+    sample arrives and the full page is only joined again after a change,
+    so a scrape is answered from memory without any device I/O.
+
+    Metrics:
+    nsmburst_pktcnt - raw value of the 32 bit drop counter
+    nsmburst_drops_delta - drops between the last two samples
+    nsmburst_drops_total - drops seen since the exporter started, corrected for counter wrap
+    nsmburst_last_sample_timestamp_seconds - time of the last sample of a host
+    nsmburst_up - 1 while the session to a host is working
+    """
+    metricHelp = [("nsmburst_pktcnt","gauge","Raw value of the ASIC queue drop counter."),
+        ("nsmburst_drops_delta","gauge","Packets dropped between the last two samples."),
+        ("nsmburst_drops_total","counter","Packets dropped since the exporter started."),
+        ("nsmburst_last_sample_timestamp_seconds","gauge","Time of the last counter sample."),
+        ("nsmburst_up","gauge","Whether the session to the host is working.")]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.totals = {}
+        self.page = None
+
+    def _escape(self,value):
+        return str(value).replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")
+
+    def update(self,host,facts,table,current,previous=None):
+        """Store sample current of an AsicCounterTable for a host, with deltas from sample previous if given"""
+        hostLabels = 'host="%s",hostname="%s",product="%s"' % (self._escape(host),self._escape(facts["hostname"]),self._escape(facts["product"]))
+        metrics = dict([(name,[]) for name,metricType,helpText in self.metricHelp])
+        totals = self.totals.setdefault(host,{})
+        for asic in table.asics:
+            for queue in table.queues:
+                value = table.get(asic,queue,current)
+                if value is None:
+                    continue
+                labels = '%s,asic="%s",queue="%s"' % (hostLabels,asic,self._escape(queue))
+                metrics["nsmburst_pktcnt"].append("nsmburst_pktcnt{%s} %d" % (labels,value))
+                if previous is not None and table.get(asic,queue,previous) is not None:
+                    delta = counterDelta(table.get(asic,queue,previous),value)
+                    totals[(asic,queue)] = totals.get((asic,queue),0) + delta
+                    metrics["nsmburst_drops_delta"].append("nsmburst_drops_delta{%s} %d" % (labels,delta))
+                if (asic,queue) in totals:
+                    metrics["nsmburst_drops_total"].append("nsmburst_drops_total{%s} %d" % (labels,totals[(asic,queue)]))
+        metrics["nsmburst_last_sample_timestamp_seconds"].append("nsmburst_last_sample_timestamp_seconds{%s} %.3f" % (hostLabels,table.times[current]))
+        metrics["nsmburst_up"].append('nsmburst_up{host="%s"} 1' % (self._escape(host)))
+        with self.lock:
+            self.hosts[host] = metrics
+            self.page = None
+
+    def markDown(self,host):
+        """Record that the session to a host has failed, its last counters are kept"""
+        with self.lock:
+            metrics = self.hosts.setdefault(host,{})
+            metrics["nsmburst_up"] = ['nsmburst_up{host="%s"} 0' % (self._escape(host))]
+            self.page = None
+
+    def render(self):
+        """Return the metrics page in the Prometheus text format"""
+        with self.lock:
+            if self.page is None:
+                lines = []
+                for name,metricType,helpText in self.metricHelp:
+                    lines.append("# HELP %s %s" % (name,helpText))
+                    lines.append("# TYPE %s %s" % (name,metricType))
+                    for host in sorted(self.hosts):
+                        lines.extend(self.hosts[host].get(name,[]))
+                self.page = "\n".join(lines) + "\n"
+            return self.page
+
+def startExporter(metrics,address,port):
+    """Serve the metrics page of a MetricsCache over HTTP on a background thread, returns the server"""
+    import BaseHTTPServer
+    import SocketServer
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ["/","/metrics"]:
+                self.send_error(404)
+                return
+            page = metrics.render()
+            self.send_response(200)
+            self.send_header("Content-Type","text/plain; version=0.0.4")
+            self.send_header("Content-Length",str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self,format,*args):
+            pass
+
+    class MetricsServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = MetricsServer((address,port),MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def watchHosts(hosts,interval,logger,output,verbose,agentOptions=None,store=None,metrics=None,detector=None,expireIntervals=10):
+    """Run a ContinuousMonitor for every host until interrupted, once every interval the detector forgets the queues not seen for expireIntervals intervals"""
+    monitors = []
+    for item in hosts:
+        monitor = ContinuousMonitor(item["host"],item["username"],item["password"],interval,logger,output,verbose,agentOptions=hostOptions(agentOptions,item),store=store,metrics=metrics,detector=detector)
+        thread = threading.Thread(target=monitor.run)
+        thread.daemon = True
+        thread.start()
+        monitors.append((monitor,thread))
+    lastExpire = time.time()
+    try:
+        while any(thread.is_alive() for monitor,thread in monitors):
+            time.sleep(1)
+            if detector is not None and time.time() - lastExpire >= interval:
+                lastExpire = time.time()
+                detector.expire(lastExpire - interval * expireIntervals)
+    except KeyboardInterrupt:
+        logger.log("Stopping monitoring",True)
+    for monitor,thread in monitors:
+        monitor.stop()
+    for monitor,thread in monitors:
+        thread.join()
+
+def main():
+    """Command line entry point"""
+    #non-module imports
+    import argparse
+    import getpass
+
+    #Create argument parser
+    parser = argparse.ArgumentParser(description="Gather options from the user")
+    parser.add_argument("---output", dest="output", action="store_true",help="Specify if you want to print output to standard out. Defaults to printing output.")
+    parser.add_argument("---no-output", dest="output", action="store_false",help="Specify if you do not want to print output to standard out.")
+    parser.set_defaults(output=True)
+    parser.add_argument("--log",dest="log",default="",help="Specify the file name where to save the output to.")
+    parser.add_argument("--log-format",dest="logFormat",default="text",choices=["text","jsonl"],help="Specify the output format, text or jsonl for one JSON object per line including a record for every counter. Defaults to text.")
+    parser.add_argument("--log-level",dest="logLevel",default="0",metavar="LOGLEVEL",help="Specify the verbosity of logging. Default 0 provides basic logging. Setting log level to 1 provides max output.")
+    parser.add_argument("--csv", dest="hostCSVFile", default="",metavar="CSVFile",help="Specify the CSV file to read hosts from.")
+    parser.add_argument("--validate", dest="validate", action="store_true", help="Only read the csv file and report the hosts found in it, without connecting to them.")
+    parser.add_argument("--host", dest="host", default="",metavar="HOST",help="Specify single host to connect to. Can not be used with --csv.")
+    parser.add_argument("--port", dest="port", default=22, type=int, metavar="PORT", help="Specify the SSH port to connect to. Defaults to 22.")
+    parser.add_argument("--username", dest="username", default="netscreen",metavar="USERNAME",help="Specify the default username to use when not specified within the csv.")
+    parser.add_argument("--password", dest="password", default="netscreen",metavar="PASSWORD",help="Specify the default password to use when not specified within the csv.")
+    parser.add_argument("--password-secure", dest="passwordSecure", action="store_true", help="Be prompted for the the default password.")
+    parser.add_argument("--watch", dest="watch", action="store_true", help="Keep a session open to each host and sample the counters until interrupted.")
+    parser.add_argument("--exporter", dest="exporter", default=0, type=int, metavar="PORT", help="Monitor the hosts as with --watch and serve the latest counters in the Prometheus text format on this port.")
+    parser.add_argument("--exporter-address", dest="exporterAddress", default="127.0.0.1", metavar="ADDRESS", help="Specify the address the exporter listens on. Defaults to 127.0.0.1.")
+    parser.add_argument("--detect", dest="detect", action="store_true", help="Only report significant bursts above the usual drop rate of each queue when using --watch.")
+    parser.add_argument("--detect-threshold", dest="detectThreshold", default=4.0, type=float, metavar="SIGMAS", help="Specify how many standard deviations above its usual drop rate a queue must be to start a burst. Defaults to 4.")
+    parser.add_argument("--detect-warmup", dest="detectWarmup", default=10, type=int, metavar="SAMPLES", help="Specify how many samples of a queue are used to learn its usual drop rate before it can start a burst. Defaults to 10.")
+    parser.add_argument("--interval", dest="interval", default=10, type=float, metavar="SECONDS", help="Specify the number of seconds between samples when using --watch. Defaults to 10.")
+    parser.add_argument("--hires", dest="hires", action="store_true", help="Sample the selected queues in a tight loop for --duration seconds and report the window with the most drops.")
+    parser.add_argument("--duration", dest="duration", default=10, type=float, metavar="SECONDS", help="Specify how long to sample for when using --hires. Defaults to 10.")
+    parser.add_argument("--window", dest="window", default=0.1, type=float, metavar="SECONDS", help="Specify the length of the windows the drops are added up in to find the peak when using --hires. Defaults to 0.1.")
+    parser.add_argument("--queues", dest="queues", default="*", metavar="PATTERNS", help="Specify a comma separated list of queue name patterns to read, for example XMT*. Defaults to all queues.")
+    parser.add_argument("--qmus", dest="qmus", default="", metavar="QMUS", help="Specify a comma separated list of QMUs to sample when using --hires. Defaults to all QMUs.")
+    parser.add_argument("--asics", dest="asics", default="", metavar="ASICS", help="Specify a comma separated list of ASICs to sample when using --hires. Defaults to all ASICs.")
+    parser.add_argument("--prime", dest="prime", action="store_true", help="Read every counter twice per sample and only keep the second read.")
+    parser.add_argument("--channels", dest="channels", default=1, type=int, metavar="N", help="Specify the number of shell sessions opened to each host to read its ASICs at the same time. Defaults to 1.")
+    parser.add_argument("--pipeline", dest="pipeline", default=1, type=int, metavar="DEPTH", help="Specify the number of commands to send to a host at once without waiting for the prompt. Defaults to 1.")
+    parser.add_argument("--store", dest="store", default="", metavar="DIR", help="Specify a directory to keep the history of every counter sample in.")
+    parser.add_argument("--facts-cache", dest="factsCache", default="", metavar="FILE", help="Specify a file to cache the system facts of each host in, so they are only gathered when the entry expires.")
+    parser.add_argument("--facts-ttl", dest="factsTTL", default=86400, type=float, metavar="SECONDS", help="Specify how long cached system facts are used for. Defaults to 86400.")
+    parser.add_argument("--summary", dest="summary", default=-1, type=int, metavar="N", help="Print the packets lost per product and per queue type and the N queues that lost the most packets across all hosts at the end of the run. Needs numpy.")
+    parser.add_argument("--timing", dest="timing", default="", metavar="FILE", help="Time every phase and command of each device session, print a summary at the end and write it to this file as JSON.")
+    parser.add_argument("--workers", dest="workers", default=1, type=int, metavar="N", help="Specify the number of hosts from the csv to poll at the same time. Defaults to 1.")
+    parser.add_argument("--jitter", dest="jitter", default=0, type=float, metavar="SECONDS", help="Wait a random time of up to this many seconds before connecting to each host from the csv. Defaults to 0.")
+    parser.add_argument("--deadline", dest="deadline", default=0, type=float, metavar="SECONDS", help="Stop starting new polls of the hosts from the csv after this many seconds and spend any time left polling lossy hosts again.")
+    parser.add_argument("--revisit", dest="revisit", default=30, type=float, metavar="SECONDS", help="Specify how long after its last poll a host that lost packets is polled again when using --deadline. Defaults to 30.")
+    parser.add_argument("--revisit-quiet", dest="revisitQuiet", default=0, type=float, metavar="SECONDS", help="Specify how long after its last poll a host without packet loss is polled again when using --deadline. Defaults to never.")
+    parser.add_argument("--command-timeout", dest="commandTimeout", default=60, type=float, metavar="SECONDS", help="Close the session to a host when a command has not finished after this many seconds, 0 waits forever. Defaults to 60.")
+    parser.add_argument("--session-timeout", dest="sessionTimeout", default=0, type=float, metavar="SECONDS", help="Close the session to a host that is still running after this many seconds, it must be longer than --duration when using --hires. Defaults to no limit.")
+    parser.add_argument("--processes", dest="processes", default=1, type=int, metavar="N", help="Split the hosts from the csv across this many processes, each polling --workers hosts at the same time. Defaults to 1.")
+    parser.add_argument("--shard", dest="shard", default="", metavar="I/N", help="Only poll the hosts from the csv in shard I of N, numbered from 0, so that N collectors can share one csv.")
+    args = parser.parse_args()
+
+    shard = None
+    if args.shard != "":
+        try:
+            shard = [int(value) for value in args.shard.split("/")]
+        except ValueError:
+            shard = []
+        if len(shard) != 2 or shard[1] < 1 or shard[0] < 0 or shard[0] >= shard[1]:
+            parser.error("--shard must be I/N with 0 <= I < N")
+    if args.detectWarmup < 0:
+        parser.error("--detect-warmup can not be negative")
+    if args.window <= 0:
+        parser.error("--window must be more than 0")
+    if args.deadline > 0 and args.processes > 1:
+        parser.error("--deadline can not be used with --processes")
+    if args.validate and args.hostCSVFile == "":
+        parser.error("--validate needs --csv")
+    if args.summary >= 0 and (args.watch or args.exporter != 0 or args.hires):
+        parser.error("--summary can not be used with --watch, --exporter or --hires")
+
+    userPassword = ""
+    verboseLogging = False
 
-            agent.disconnect()
+    #check for secure password
+    if args.passwordSecure == True:
+        password = getpass.getpass()
+        userPassword = password
+    else:
+        userPassword = args.password
+
+    #check for logging level
+    if args.logLevel == "0":
+        verboseLogging = False
+    elif args.logLevel == "1":
+        verboseLogging = True
+
+    agentOptions = {"pipelineDepth":args.pipeline,"port":args.port,"queuePatterns":args.queues.split(","),"primeReads":args.prime,"channels":args.channels}
+    agentOptions["commandTimeout"] = args.commandTimeout or None
+    if args.sessionTimeout > 0:
+        agentOptions["sessionTimeout"] = args.sessionTimeout
+
+    factsCache = None
+    if args.factsCache != "":
+        factsCache = FactsCache(args.factsCache,args.factsTTL)
+        agentOptions["factsCache"] = factsCache
+
+    store = None
+    if args.store != "":
+        store = CounterStore(args.store)
+
+    timing = None
+    if args.timing != "":
+        timing = TimingReport()
+        agentOptions["timing"] = timing
+
+    metrics = None
+    if args.exporter != 0:
+        args.watch = True
+        metrics = MetricsCache()
+
+    deltas = None
+    if args.summary >= 0 and not args.validate:
+        deltas = DeltaEngine()
+
+    detector = None
+    if args.detect:
+        detector = BurstDetector(threshold=args.detectThreshold,warmup=args.detectWarmup)
+
+    pollFunction = pollHost
+    if args.hires:
+        qmus = None
+        asics = None
+        if args.qmus != "":
+            qmus = [int(qmu) for qmu in args.qmus.split(",")]
+        if args.asics != "":
+            asics = [int(asic) for asic in args.asics.split(",")]
+        def pollFunction(host,username,password,output,verbose,agentOptions=None,store=None):
+            return pollHostHighRate(host,username,password,output,verbose,agentOptions,store,args.queues.split(","),qmus,asics,args.duration,args.window)
+
+    logger = OutputLogger(args.output,args.log,args.logFormat,background=True)
+    logger.addPrefix(socket.gethostname())
+
+    exporter = None
+    if metrics is not None:
+        exporter = startExporter(metrics,args.exporterAddress,args.exporter)
+        logger.log("Serving metrics on http://%s:%s/metrics" % (args.exporterAddress,args.exporter),True)
 
-            counters = agent.compareAsicCounters()
-            for line in counters:
-                logger.log(line,True)
-            logger.log("======================================================================\n",True)
+    try:
+        if args.hostCSVFile != "": #check if singular hosts are specified
+
+            hp = HostParser(args.hostCSVFile,args.username,userPassword,args.port)
+            hosts = hp.hosts()
+            if shard is not None:
+                hosts = shardHosts(hosts,shard[0],shard[1])
+            if args.validate:
+                count = 0
+                for item in hosts:
+                    count = count + 1
+                    logger.log("Host %s username %s%s" % (item["host"],item["username"],"".join([" %s %s" % (name,value) for name,value in sorted(item["options"].items())])),True)
+                for error in hp.errors:
+                    logger.log(error,True)
+                logger.log("Found %s hosts in %s CSV file, skipped %s duplicate(s) and %s invalid row(s)." % (count,args.hostCSVFile,hp.duplicates,len(hp.errors)),True)
+                return
+            if args.output:
+                logger.log("Reading hosts from %s CSV file. Starting stats gathering." % (args.hostCSVFile),True)
+
+            if args.watch:
+                #every host gets its own monitor, so the whole inventory is read before they start
+                hosts = list(hosts)
+                for error in hp.errors:
+                    logger.log(error,True)
+                logger.log("Found %s hosts in %s CSV file, skipped %s duplicate(s) and %s invalid row(s)." % (len(hosts),args.hostCSVFile,hp.duplicates,len(hp.errors)),True)
+                watchHosts(hosts,args.interval,logger,args.output,verboseLogging,agentOptions,store,metrics,detector)
+            else:
+                if args.deadline > 0:
+                    minimumPoll = 3
+                    if args.hires:
+                        minimumPoll = args.duration + 1
+                    fleetSweep = DeadlineSweep(hosts,args.output,verboseLogging,args.workers,agentOptions,store,pollFunction,args.jitter,args.deadline,args.revisit,args.revisitQuiet or None,minimumPoll)
+                elif args.processes > 1:
+                    fleetSweep = ShardedSweep(hosts,args.output,verboseLogging,args.workers,agentOptions,store,pollFunction,args.processes,args.jitter)
+                else:
+                    fleetSweep = FleetSweep(hosts,args.output,verboseLogging,args.workers,agentOptions,store,pollFunction,args.jitter)
+                fleetSweep.deltas = deltas
+                fleetSweep.run(logger,False)
+                polled = fleetSweep.completed
+                skipped = 0
+                if args.deadline > 0:
+                    #completed also counts every revisit and every skipped host
+                    skipped = fleetSweep.skipped
+                    polled = fleetSweep.completed - fleetSweep.revisited - skipped
+                for error in hp.errors:
+                    logger.log(error,True)
+                if polled + skipped == 0:
+                    logger.log("Found 0 hosts in %s CSV file. No hosts to gather stats from." % (args.hostCSVFile),True)
+                elif args.output:
+                    logger.log("Polled %s hosts from %s CSV file." % (polled,args.hostCSVFile),True)
+                if args.deadline > 0:
+                    logger.log("Polled hosts again %s times and skipped %s hosts within the %s second deadline." % (fleetSweep.revisited,skipped,args.deadline),True)
+                if fleetSweep.timedOut > 0:
+                    logger.log("Sessions to %s hosts timed out." % (fleetSweep.timedOut),True)
+        elif args.host != "":
+            if args.watch:
+                watchHosts([{"host":args.host,"username":args.username,"password":userPassword}],args.interval,logger,args.output,verboseLogging,agentOptions,store,metrics,detector)
+            else:
+                result = pollFunction(args.host,args.username,userPassword,args.output,verboseLogging,agentOptions,store)
+                result.replay(logger)
+                if deltas is not None:
+                    deltas.addResult(result)
         else:
-            logger.log("Failed to fetch system facts about host: %s" % (args.host),True)
-    except Exception, e:
-        logger.log(str(e))
-else:
-    parser.print_help()
+            parser.print_help()
+    finally:
+        if exporter is not None:
+            exporter.shutdown()
+        if deltas is not None and len(deltas.hosts) > 0:
+            for line in deltas.summaryLines(deltas.summary(args.summary)):
+                logger.log(line,True)
+        if timing is not None and len(timing.sessions) > 0:
+            summary = timing.summary()
+            for line in timing.summaryLines(summary):
+                logger.log(line,True)
+            timing.save(args.timing,summary)
+        if factsCache is not None:
+            factsCache.save()
+        logger.stop()
+
+if __name__ == "__main__":
+    main()
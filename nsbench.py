@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the nsautomate collection pipeline
+
+Times each stage of a sweep on its own, using generated transcripts and
+simulated devices from nssim, and writes the results as JSON so runs from
+different commits can be compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import tempfile
+import platform
+import subprocess
+import argparse
+
+import nsautomate
+import nssim
+
+class ReplayChannel:
+    """
+    ReplayChannel
+
+    Stands in for a paramiko channel. Every command sent replays the same
+    transcript, returned in chunks of at most chunkSize bytes.
+    """
+    def __init__(self,transcript,chunkSize=1024):
+        self.transcript = transcript
+        self.chunkSize = chunkSize
+        self.position = len(transcript)
+
+    def send(self,data):
+        self.position = 0
+        return len(data)
+
+    def sendall(self,data):
+        self.send(data)
+
+    def recv(self,size):
+        size = min(size,self.chunkSize)
+        data = self.transcript[self.position:self.position + size]
+        self.position = self.position + len(data)
+        return data
+
+def measure(function,iterations,repeat):
+    """Run function iterations times, repeat times over, and return the per call time statistics in seconds"""
+    runs = []
+    for index in range(repeat):
+        start = timeit.default_timer()
+        for call in range(iterations):
+            function()
+        runs.append((timeit.default_timer() - start) / iterations)
+    runs.sort()
+    return {"iterations":iterations,"repeat":repeat,"min":runs[0],"median":runs[len(runs) // 2],"max":runs[-1]}
+
+def buildAgent(product,hostname="bench"):
+    """Create an agent with system facts filled in without connecting"""
+    agent = nsautomate.NetScreenAgent(hostname,"netscreen","netscreen",True)
+    agent.systemFacts["hostname"] = hostname
+    agent.systemFacts["product"] = product
+    return agent
+
+def benchHostParser(rows,iterations,repeat):
+    """Time HostParser on a generated inventory"""
+    handle,path = tempfile.mkstemp(suffix=".csv")
+    inventory = os.fdopen(handle,"w")
+    inventory.write("#Generated inventory\n")
+    for index in range(rows):
+        inventory.write("10.%s.%s.%s,netscreen,netscreen\n" % (index // 65536 % 256,index // 256 % 256,index % 256))
+    inventory.close()
+    try:
+        result = measure(lambda: nsautomate.HostParser(path).getHosts(),iterations,repeat)
+    finally:
+        os.remove(path)
+    result["rows"] = rows
+    return result
+
+def benchReceive(lines,iterations,repeat):
+    """Time runCommand reading and splitting a long output from a replayed transcript"""
+    device = nssim.buildDevices(1,"NetScreen-5400-III")[0]
+    output = []
+    while len(output) < lines:
+        output.extend(device.pktcnt(1,"7"))
+    transcript = "get asic 1 engine qmu pktcnt 7\r\n" + "".join([line + "\r\n" for line in output[:lines]]) + "bench-> "
+    agent = buildAgent("NetScreen-5400-III")
+    agent.chan = ReplayChannel(transcript)
+    agent.reader = nsautomate.PromptReader(agent.chan,agent.remoteHost)
+    result = measure(lambda: agent.runCommand("get asic 1 engine qmu pktcnt 7"),iterations,repeat)
+    result["lines"] = lines
+    result["bytes"] = len(transcript)
+    return result
+
+def benchParse(transcript,iterations,repeat):
+    """Time parsing one sample of every pktcnt output of a NetScreen-5400-III with the cell maps of its PollPlan"""
+    plan = nsautomate.pollPlan("NetScreen-5400-III")
+    table = plan.newTable()
+    if transcript == "":
+        device = nssim.buildDevices(1,"NetScreen-5400-III")[0]
+        qmuList = nsautomate.ASICList["NetScreen-5400-III"]["qmu_list"]
+        #every queue is selected, so there is a command for each asic and qmu in the order of the plan
+        outputs = ["\n".join(device.pktcnt(asic,str(qmu))) for asic in plan.asics for qmu in qmuList]
+    else:
+        outputs = [open(transcript).read()] * len(plan.parseMap)
+    steps = zip(plan.parseMap,outputs)
+    def parse():
+        for cells,output in steps:
+            table.parseCells(cells,0,output)
+    result = measure(parse,iterations,repeat)
+    result["outputs"] = len(outputs)
+    return result
+
+def benchCompare(iterations,repeat):
+    """Time compareAsicCounters on a full NetScreen-5400-III table"""
+    agent = buildAgent("NetScreen-5400-III")
+    table = agent.newCounterTable()
+    for offset in range(len(table.values)):
+        table.values[offset] = offset
+        table.present[offset] = 1
+    agent.asicCounters = table
+    result = measure(agent.compareAsicCounters,iterations,repeat)
+    result["counters"] = len(table.asics) * len(table.queues)
+    return result
+
+def benchDeltas(hosts,iterations,repeat):
+    """Time DeltaEngine summarising a full NetScreen-5400-III table from each of many hosts"""
+    table = nsautomate.pollPlan("NetScreen-5400-III").newTable()
+    for offset in range(len(table.values)):
+        table.values[offset] = (offset * 2654435761) & 0xFFFFFFFF
+        table.present[offset] = 1
+    table.times[1] = 10.0
+    engine = nsautomate.DeltaEngine()
+    for index in range(hosts):
+        engine.addTable("10.%s.%s.%s" % (index // 65536 % 256,index // 256 % 256,index % 256),"NetScreen-5400-III",table)
+    result = measure(lambda: engine.summary(10),iterations,repeat)
+    result["hosts"] = hosts
+    result["counters"] = engine.compute()
+    return result
+
+def benchLog(lines,iterations,repeat):
+    """Time OutputLogger.log writing time stamped lines to a file"""
+    handle,path = tempfile.mkstemp(suffix=".log")
+    os.close(handle)
+    logger = nsautomate.OutputLogger(False,path)
+    logger.addPrefix("bench")
+    message = "pktcnt[XMT1-d  ] = 0x00000000          0"
+    def log():
+        for index in range(lines):
+            logger.log(message,True)
+    try:
+        result = measure(log,iterations,repeat)
+    finally:
+        logger.stop()
+        os.remove(path)
+    result["lines"] = lines
+    return result
+
+def benchCommandLatency(simulator,commands):
+    """Time individual pktcnt commands against a simulated device"""
+    agent = nsautomate.NetScreenAgent(simulator.addresses()[0],"netscreen","netscreen",False,port=simulator.port)
+    agent.connect()
+    agent.getSystemFacts()
+    command = agent.pollPlan().commands[0]
+    samples = []
+    for index in range(commands):
+        start = timeit.default_timer()
+        agent.runCommand(command)
+        samples.append(timeit.default_timer() - start)
+    agent.disconnect()
+    return nsautomate.latencyPercentiles(samples)
+
+def benchSweep(simulator,hostCounts,workers):
+    """Time a full sweep against a growing number of simulated devices"""
+    addresses = simulator.addresses()
+    logger = nsautomate.OutputLogger(False)
+    results = {}
+    for count in hostCounts:
+        hosts = [{"host":address,"username":"netscreen","password":"netscreen"} for address in addresses[:count]]
+        sweep = nsautomate.FleetSweep(hosts,False,False,workers,{"port":simulator.port})
+        start = timeit.default_timer()
+        sweep.run(logger)
+        results[str(count)] = timeit.default_timer() - start
+    return results
+
+def gitCommit():
+    """Return the commit the benchmark ran against"""
+    try:
+        return subprocess.check_output(["git","rev-parse","HEAD"],cwd=os.path.dirname(os.path.abspath(__file__)),stderr=open(os.devnull,"w")).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return ""
+
+def compareResults(baseline,current,threshold):
+    """Return a list of stages that are slower than the baseline by more than threshold"""
+    regressions = []
+    for stage in sorted(current["stages"]):
+        if stage not in baseline["stages"]:
+            continue
+        before = baseline["stages"][stage]
+        after = current["stages"][stage]
+        for key in ["median","p50","p90"]:
+            if key in before and key in after and before[key] > 0:
+                change = (after[key] - before[key]) / before[key]
+                if change > threshold:
+                    regressions.append("%s %s %.6f -> %.6f (%+.0f%%)" % (stage,key,before[key],after[key],change * 100))
+    return regressions
+
+def main():
+    """Command line entry point"""
+    stageNames = ["hostparser","receive","parse","compare","deltas","log","latency","sweep"]
+    parser = argparse.ArgumentParser(description="Benchmark the nsautomate collection pipeline")
+    parser.add_argument("--stages", dest="stages", default=",".join(stageNames), metavar="STAGES", help="Specify a comma separated list of stages to run. Defaults to %s." % (",".join(stageNames)))
+    parser.add_argument("--repeat", dest="repeat", default=5, type=int, metavar="N", help="Specify the number of times each stage is repeated. Defaults to 5.")
+    parser.add_argument("--rows", dest="rows", default=20000, type=int, metavar="N", help="Specify the number of inventory rows for the hostparser stage. Defaults to 20000.")
+    parser.add_argument("--lines", dest="lines", default=5000, type=int, metavar="N", help="Specify the number of output lines for the receive and log stages. Defaults to 5000.")
+    parser.add_argument("--transcript", dest="transcript", default="", metavar="FILE", help="Specify a recorded pktcnt output to use in the parse stage instead of generated output.")
+    parser.add_argument("--fleet", dest="fleet", default=5000, type=int, metavar="N", help="Specify the number of hosts summarised in the deltas stage. Defaults to 5000.")
+    parser.add_argument("--hosts", dest="hosts", default="1,4,16,64", metavar="COUNTS", help="Specify a comma separated list of host counts for the sweep stage. Defaults to 1,4,16,64.")
+    parser.add_argument("--workers", dest="workers", default=16, type=int, metavar="N", help="Specify the number of workers for the sweep stage. Defaults to 16.")
+    parser.add_argument("--commands", dest="commands", default=200, type=int, metavar="N", help="Specify the number of commands timed in the latency stage. Defaults to 200.")
+    parser.add_argument("--latency", dest="latency", default=0.0, type=float, metavar="SECONDS", help="Specify the simulated device latency for the latency and sweep stages. Defaults to 0.")
+    parser.add_argument("--port", dest="port", default=0, type=int, metavar="PORT", help="Specify the port for the simulated devices. Defaults to a free port.")
+    parser.add_argument("--output", dest="output", default="", metavar="FILE", help="Write the results to a file instead of standard out.")
+    parser.add_argument("--compare", dest="compare", default="", metavar="FILE", help="Compare the results with an earlier run and exit with an error if any stage regressed.")
+    parser.add_argument("--threshold", dest="threshold", default=0.2, type=float, metavar="FRACTION", help="Specify how much slower a stage may be before it counts as a regression. Defaults to 0.2.")
+    args = parser.parse_args()
+
+    stages = args.stages.split(",")
+    for stage in stages:
+        if stage not in stageNames:
+            parser.error("unknown stage %s" % (stage))
+
+    results = {"commit":gitCommit(),"python":platform.python_version(),"platform":platform.platform(),"time":time.time(),"stages":{}}
+    if "hostparser" in stages:
+        results["stages"]["hostparser"] = benchHostParser(args.rows,1,args.repeat)
+    if "receive" in stages:
+        results["stages"]["receive"] = benchReceive(args.lines,20,args.repeat)
+    if "parse" in stages:
+        results["stages"]["parse"] = benchParse(args.transcript,100,args.repeat)
+    if "compare" in stages:
+        results["stages"]["compare"] = benchCompare(100,args.repeat)
+    if "deltas" in stages:
+        results["stages"]["deltas"] = benchDeltas(args.fleet,10,args.repeat)
+    if "log" in stages:
+        results["stages"]["log"] = benchLog(args.lines,1,args.repeat)
+
+    if "latency" in stages or "sweep" in stages:
+        hostCounts = [int(count) for count in args.hosts.split(",")]
+        devices = nssim.buildDevices(max(hostCounts + [1]))
+        simulator = nssim.Simulator(devices,port=args.port,latency=args.latency)
+        simulator.start()
+        try:
+            if "latency" in stages:
+                results["stages"]["latency"] = benchCommandLatency(simulator,args.commands)
+            if "sweep" in stages:
+                for count,seconds in benchSweep(simulator,hostCounts,args.workers).items():
+                    results["stages"]["sweep.%s" % (count)] = {"median":seconds,"hosts":int(count),"workers":args.workers}
+        finally:
+            simulator.stop()
+
+    report = json.dumps(results,indent=2,sort_keys=True)
+    if args.output != "":
+        outputFile = open(args.output,"w")
+        outputFile.write(report + "\n")
+        outputFile.close()
+    else:
+        print report
+
+    if args.compare != "":
+        regressions = compareResults(json.load(open(args.compare)),results,args.threshold)
+        for line in regressions:
+            sys.stderr.write("Regression: %s\n" % (line))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
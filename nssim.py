@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""
+NetScreen CLI simulator
+
+Runs local SSH servers that behave like the ScreenOS shell of ASIC-based
+NetScreen platforms so nsautomate can be tested and load tested without
+lab devices. Each simulated device listens on its own loopback address,
+starting at --listen, and all devices share the same --port.
+"""
+import socket
+import select
+import struct
+import threading
+import random
+import time
+import argparse
+import logging
+import paramiko
+
+from nsautomate import ASICList, BUFFERList
+
+#The full set of queues reported by "get asic engine qmu pktcnt" for each qmu
+QMUQueues = {"1":["PSR1","PSR2","PSR3","PSR4","PSR5","PSR6","PSR7","PSR8","CPU2-d"], "2":["XMT1","XMT2","XMT3","XMT4","XMT5","XMT6","XMT7","XMT8","CPU1-d","RSM1-d"], "4":["XMT5","XMT6","XMT7","XMT8","PSR5","PSR6","PSR7","PSR8","PSRB","L2Q-d"], "6":["PSR1-d","PSR2-d","PSR3-d","PSR4-d","PSR5-d","PSR6-d","PSR7-d","PSR8-d","SLU-d","SLI-d","SPI-d"], "7":["XMT1-d","XMT2-d","XMT3-d","XMT4-d","XMT5-d","XMT6-d","XMT7-d","XMT8-d","PPA-d","PPB-d"], "9":["CPU1","RSM2-d","CPU3-d","CPU4-d","CPU5-d","PPC-d","PPD-d"]}
+#The qactctl register value shown in the header of each qmu
+QMUSelect = {"1":0x00, "2":0x04, "4":0x0c, "6":0x14, "7":0x18, "9":0x20}
+#ISG platforms have a single ASIC and do not take an ASIC id
+ISGProducts = ["NetScreen-1000","NetScreen-2000"]
+
+#clients dropping their connections is normal, keep paramiko from reporting it
+logging.getLogger("paramiko").addHandler(logging.NullHandler())
+
+class SimulatedDevice:
+    """
+    SimulatedDevice
+
+    Holds the identity and counter model of a single simulated device. Each
+    drop queue listed in BUFFERList grows at its own rate, a fraction of the
+    queues set by lossy drop between zero and growth packets per second and
+    the rest never drop. Counters start at counterStart and wrap at 32 bits
+    like the hardware counters.
+    """
+    def __init__(self,hostname,product,serialNumber,version="6.2.0r9-cu4.0",growth=10.0,lossy=0.1,counterStart=0,seed=0):
+        self.hostname = hostname
+        self.product = product
+        self.serialNumber = serialNumber
+        self.version = version
+        self.counterStart = counterStart
+        self.started = time.time()
+        self.rates = {}
+        rand = random.Random(seed)
+        for asic in ASICList[product]["asic_list"]:
+            for qmu in ASICList[product]["qmu_list"]:
+                for queue in BUFFERList[str(qmu)]:
+                    if rand.random() < lossy:
+                        self.rates[(asic,queue)] = rand.uniform(0,growth)
+
+    def counter(self,asic,queue,now):
+        """Return the value of a counter at the given time"""
+        rate = self.rates.get((asic,queue),0)
+        return (self.counterStart + int(rate * (now - self.started))) & 0xFFFFFFFF
+
+    def pktcnt(self,asic,qmu):
+        """Return the output of get asic engine qmu pktcnt for an asic and qmu"""
+        now = time.time()
+        lines = ["qgroup select register: qactctl(0x800005d8)=0x%08x, PKTCNT(0x80000598)" % (QMUSelect[qmu])]
+        for queue in QMUQueues[qmu]:
+            value = self.counter(asic,queue,now)
+            lines.append("pktcnt[%-8s] = 0x%08x %10d" % (queue,value,value))
+        return lines
+
+    def system(self):
+        """Return the output of get system"""
+        return ["Product Name: %s" % (self.product),
+            "Serial Number: %s, Control Number: 00000000" % (self.serialNumber),
+            "Hardware Version: 4010(0)-(00), FPGA checksum: 00000000, VLAN1 IP (0.0.0.0)",
+            "Software Version: %s, Type: Firewall+VPN" % (self.version),
+            "Feature: AV-K",
+            "Compiled by build_master at: Tue Jun 10 15:21:12 PDT 2014",
+            "Base Mac: 0010.db00.0001",
+            "File Name: ns5400.6.2.0r9-cu4.0, Checksum: 9b1ff6b7",
+            "Total Device Resets: 0",
+            "",
+            "System up time: %d seconds" % (time.time() - self.started)]
+
+class SimulatedShell:
+    """
+    SimulatedShell
+
+    Runs the ScreenOS command line on a single SSH channel. Input is read a
+    line at a time, each line is echoed back, answered and followed by the
+    prompt. When paging is enabled output stops after every page until a key
+    is pressed. latency delays each response and bandwidth limits the rate
+    output is written in bytes per second.
+    """
+    def __init__(self,device,chan,latency=0.0,bandwidth=0):
+        self.device = device
+        self.chan = chan
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.pageSize = 20
+        self.pending = ""
+        self.prompt = "%s-> " % (device.hostname)
+
+    def _send(self,data):
+        """Write data to the channel at the configured bandwidth"""
+        if self.bandwidth <= 0:
+            self.chan.sendall(data)
+            return
+        for start in range(0,len(data),1024):
+            chunk = data[start:start + 1024]
+            self.chan.sendall(chunk)
+            time.sleep(float(len(chunk)) / self.bandwidth)
+
+    def _readKey(self):
+        """Wait for a single key press, returns an empty string if the channel is closed"""
+        if self.pending == "":
+            self.pending = self.chan.recv(1024)
+        key = self.pending[:1]
+        self.pending = self.pending[1:]
+        return key
+
+    def _sendLines(self,lines):
+        """Write the output of a command, paging it if required"""
+        if self.pageSize == 0 or len(lines) <= self.pageSize:
+            self._send("".join([line + "\r\n" for line in lines]))
+            return
+        for start in range(0,len(lines),self.pageSize):
+            self._send("".join([line + "\r\n" for line in lines[start:start + self.pageSize]]))
+            if start + self.pageSize < len(lines):
+                self._send("--- more --- ")
+                key = self._readKey()
+                self._send("\r" + " " * 13 + "\r")
+                if key == "" or key == "q":
+                    return
+
+    def execute(self,line):
+        """Answer a single command line, returns False when the session should end"""
+        words = line.split()
+        if len(words) == 0:
+            return True
+        if words[0] == "exit":
+            return False
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if words[:3] == ["set","console","page"] and len(words) == 4 and words[3].isdigit():
+            self.pageSize = int(words[3])
+        elif words == ["get","hostname"]:
+            self._sendLines(["Hostname: %s" % (self.device.hostname)])
+        elif words == ["get","system"]:
+            self._sendLines(self.device.system())
+        elif words[:1] == ["get"] and "pktcnt" in words:
+            self._sendLines(self._pktcnt(words))
+        else:
+            self._sendLines(["                   ^-----unknown keyword %s" % (words[-1])])
+        return True
+
+    def _pktcnt(self,words):
+        """Answer get asic [id] engine qmu pktcnt qmu"""
+        asicList = ASICList[self.device.product]["asic_list"]
+        qmuList = [str(qmu) for qmu in ASICList[self.device.product]["qmu_list"]]
+        if self.device.product in ISGProducts:
+            pattern = ["get","asic","engine","qmu","pktcnt"]
+            asic = asicList[0]
+            rest = words[5:]
+        else:
+            pattern = ["get","asic",None,"engine","qmu","pktcnt"]
+            asic = words[2] if len(words) > 2 and words[2].isdigit() else None
+            if asic is not None:
+                asic = int(asic)
+            rest = words[6:]
+        if len(words) != len(pattern) + 1 or [word for word,expected in zip(words,pattern) if expected is not None and word != expected]:
+            return ["                   ^-----unknown keyword %s" % (words[-1])]
+        if asic not in asicList:
+            return ["invalid asic id %s" % (words[2])]
+        if rest[0] not in qmuList:
+            return ["invalid qmu id %s" % (rest[0])]
+        return self.device.pktcnt(asic,rest[0])
+
+    def run(self):
+        """Run the shell until the client exits or the channel closes"""
+        try:
+            self._send("\r\n" + self.prompt)
+            while True:
+                while "\n" not in self.pending:
+                    data = self.chan.recv(4096)
+                    if data == "":
+                        return
+                    self.pending += data.replace("\r\n","\n").replace("\r","\n")
+                line,self.pending = self.pending.split("\n",1)
+                self._send(line + "\r\n")
+                if not self.execute(line):
+                    return
+                self._send(self.prompt)
+        except (socket.error,EOFError):
+            pass
+        finally:
+            self.chan.close()
+
+class _SSHServer(paramiko.ServerInterface):
+    """Accepts password logins and shell sessions for a simulated device"""
+    def __init__(self,username,password):
+        self.username = username
+        self.password = password
+        self.lock = threading.Lock()
+        self.shells = {}
+
+    def shellEvent(self,chanid):
+        with self.lock:
+            if chanid not in self.shells:
+                self.shells[chanid] = threading.Event()
+            return self.shells[chanid]
+
+    def get_allowed_auths(self,username):
+        return "password"
+
+    def check_auth_password(self,username,password):
+        if username == self.username and password == self.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self,kind,chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self,channel,term,width,height,pixelwidth,pixelheight,modes):
+        return True
+
+    def check_channel_shell_request(self,channel):
+        self.shellEvent(channel.get_id()).set()
+        return True
+
+class Simulator:
+    """
+    Simulator
+
+    Listens for SSH connections for a set of simulated devices. Device i
+    listens on the address i after the base listen address, so every device
+    can use the same port. Each connection runs on its own thread and every
+    shell session opened on a connection gets its own SimulatedShell.
+    """
+    def __init__(self,devices,listen="127.0.0.1",port=2222,username="netscreen",password="netscreen",hostKey=None,latency=0.0,bandwidth=0):
+        self.devices = devices
+        self.listen = listen
+        self.port = port
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.bandwidth = bandwidth
+        if hostKey is None:
+            hostKey = paramiko.RSAKey.generate(2048)
+        self.hostKey = hostKey
+        self.sockets = {}
+        self.running = False
+
+    def addresses(self):
+        """Return the listen address of each device in order"""
+        base = struct.unpack("!I",socket.inet_aton(self.listen))[0]
+        return [socket.inet_ntoa(struct.pack("!I",base + index)) for index in range(len(self.devices))]
+
+    def start(self):
+        """Open the listening sockets and start accepting connections in the background"""
+        for address,device in zip(self.addresses(),self.devices):
+            sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+            sock.bind((address,self.port))
+            sock.listen(128)
+            #when port 0 is given every device shares the port picked for the first one
+            self.port = sock.getsockname()[1]
+            self.sockets[sock] = device
+        self.running = True
+        thread = threading.Thread(target=self._acceptLoop)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop accepting new connections"""
+        self.running = False
+        for sock in self.sockets:
+            sock.close()
+
+    def _acceptLoop(self):
+        while self.running:
+            try:
+                readable,writable,failed = select.select(self.sockets.keys(),[],[],0.5)
+            except (select.error,socket.error):
+                return
+            for sock in readable:
+                try:
+                    client,address = sock.accept()
+                except socket.error:
+                    continue
+                thread = threading.Thread(target=self._serve,args=(client,self.sockets[sock]))
+                thread.daemon = True
+                thread.start()
+
+    def _serve(self,client,device):
+        """Run the SSH transport of a single connection"""
+        client.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.hostKey)
+        server = _SSHServer(self.username,self.password)
+        try:
+            transport.start_server(server=server)
+            while transport.is_active():
+                chan = transport.accept(1)
+                if chan is None:
+                    continue
+                if not server.shellEvent(chan.get_id()).wait(10):
+                    chan.close()
+                    continue
+                shell = SimulatedShell(device,chan,self.latency,self.bandwidth)
+                thread = threading.Thread(target=shell.run)
+                thread.daemon = True
+                thread.start()
+        except (paramiko.SSHException,socket.error,EOFError):
+            pass
+        finally:
+            transport.close()
+
+def buildDevices(count,product="",growth=10.0,lossy=0.1,counterStart=0,seed=0):
+    """Create count simulated devices, cycling through the ASICList products unless a product is given"""
+    products = sorted(ASICList.keys())
+    devices = []
+    for index in range(count):
+        if product != "":
+            deviceProduct = product
+        else:
+            deviceProduct = products[index % len(products)]
+        devices.append(SimulatedDevice("sim%04d" % (index),deviceProduct,"%016d" % (4700000000000000 + index),growth=growth,lossy=lossy,counterStart=counterStart,seed=seed + index))
+    return devices
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Simulate NetScreen devices for testing nsautomate")
+    parser.add_argument("--devices", dest="devices", default=1, type=int, metavar="N", help="Specify the number of devices to simulate. Defaults to 1.")
+    parser.add_argument("--product", dest="product", default="", choices=sorted(ASICList.keys()), metavar="PRODUCT", help="Specify the product of every device. Defaults to cycling through all ASIC-based products.")
+    parser.add_argument("--listen", dest="listen", default="127.0.0.1", metavar="ADDRESS", help="Specify the address of the first device, each following device uses the next address. Defaults to 127.0.0.1.")
+    parser.add_argument("--port", dest="port", default=2222, type=int, metavar="PORT", help="Specify the SSH port of the devices. Defaults to 2222.")
+    parser.add_argument("--username", dest="username", default="netscreen", metavar="USERNAME", help="Specify the username the devices accept.")
+    parser.add_argument("--password", dest="password", default="netscreen", metavar="PASSWORD", help="Specify the password the devices accept.")
+    parser.add_argument("--host-key", dest="hostKey", default="", metavar="FILE", help="Specify an RSA host key file. Defaults to generating a new key.")
+    parser.add_argument("--growth", dest="growth", default=10.0, type=float, metavar="PPS", help="Specify the maximum drop rate in packets per second of a lossy queue. Defaults to 10.")
+    parser.add_argument("--lossy", dest="lossy", default=0.1, type=float, metavar="FRACTION", help="Specify the fraction of queues that drop packets. Defaults to 0.1.")
+    parser.add_argument("--counter-start", dest="counterStart", default=0, type=int, metavar="VALUE", help="Specify the starting value of every counter. Defaults to 0.")
+    parser.add_argument("--latency", dest="latency", default=0.0, type=float, metavar="SECONDS", help="Specify the delay before each command is answered. Defaults to 0.")
+    parser.add_argument("--bandwidth", dest="bandwidth", default=0, type=int, metavar="BYTES", help="Specify the output rate of each session in bytes per second. Defaults to unlimited.")
+    parser.add_argument("--seed", dest="seed", default=0, type=int, metavar="SEED", help="Specify the random seed used to pick the lossy queues.")
+    parser.add_argument("--inventory", dest="inventory", default="", metavar="CSVFile", help="Write a CSV file listing the simulated devices for use with nsautomate --csv.")
+    args = parser.parse_args()
+
+    hostKey = None
+    if args.hostKey != "":
+        hostKey = paramiko.RSAKey(filename=args.hostKey)
+
+    devices = buildDevices(args.devices,args.product,args.growth,args.lossy,args.counterStart,args.seed)
+    simulator = Simulator(devices,args.listen,args.port,args.username,args.password,hostKey,args.latency,args.bandwidth)
+    simulator.start()
+
+    if args.inventory != "":
+        inventory = open(args.inventory,"w")
+        inventory.write("#Simulated devices, use with --port %s\n" % (simulator.port))
+        for address in simulator.addresses():
+            inventory.write("%s,%s,%s\n" % (address,args.username,args.password))
+        inventory.close()
+
+    addresses = simulator.addresses()
+    print "Simulating %s devices on %s-%s port %s" % (len(devices),addresses[0],addresses[-1],simulator.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import os
+import tempfile
+
+import nssim
+import nsautomate
+
+#Simulate one device of every ASIC-based product on a free port
+devices = nssim.buildDevices(len(nsautomate.ASICList),growth=100,lossy=0.5)
+simulator = nssim.Simulator(devices,port=0)
+simulator.start()
+
+for address in simulator.addresses():
+    agent = nsautomate.NetScreenAgent(address,"netscreen","netscreen",True,port=simulator.port)
+    agent.connect()
+    agent.getSystemFacts()
+    print agent.systemFacts
+    table, verboseOutput = agent.getAllAsicCounters(False)
+    agent.disconnect()
+    for line in agent.compareAsicCounters():
+        print line
+
+#Sweep the devices from worker processes, their timing and cached facts must reach the parent
+handle,cachePath = tempfile.mkstemp(suffix=".json")
+os.close(handle)
+os.remove(cachePath)
+timing = nsautomate.TimingReport()
+factsCache = nsautomate.FactsCache(cachePath)
+hosts = [{"host":address,"username":"netscreen","password":"netscreen"} for address in simulator.addresses()]
+sweep = nsautomate.ShardedSweep(hosts,False,False,2,{"port":simulator.port,"timing":timing,"factsCache":factsCache},processes=2)
+sweep.run(nsautomate.OutputLogger(False))
+print "Sharded sweep returned %s timing sessions and %s cached facts for %s hosts" % (len(timing.sessions),len(factsCache.entries),len(hosts))
+assert len(timing.sessions) == len(hosts)
+assert len(factsCache.entries) == len(hosts)
+
+simulator.stop()